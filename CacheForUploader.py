@@ -0,0 +1,143 @@
+import os
+import sqlite3
+from collections import OrderedDict
+from itertools import islice
+
+from JournalForUploader import file_key
+
+
+class UploadCache:
+    """ Кеш загруженных файлов в SQLite: по ключу пути (64-битный хеш, как в журнале) хранятся размер, время
+     изменения (mtime_ns) и хеш содержимого файла на момент загрузки. Файл с теми же размером и временем изменения
+     считается не изменившимся и не загружается, даже не читаясь. Количество записей ограничено max_entries,
+     лишние вытесняются по давности использования (LRU); записи читаются в память при открытии, а изменения
+     записываются одной транзакцией при закрытии. В памяти каждая запись занимает около 300 байт """
+
+    def __init__(self, path=':memory:', max_entries=1000000):
+        self.path = path  # Путь к файлу кеша (':memory:' - кеш только на время загрузки)
+        self.max_entries = max_entries  # Максимальное количество записей
+
+        self._connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS entries (key INTEGER PRIMARY KEY, size INTEGER, '
+                                 'mtime_ns INTEGER, digest BLOB, used INTEGER)')
+
+        # Ключ пути -> (размер, mtime_ns, хеш содержимого) от давно использованных к недавним
+        self._entries = OrderedDict()
+        self._used = 0  # Наибольший номер использования среди записей в файле
+        for key, size, mtime_ns, digest, used in self._connection.execute('SELECT * FROM entries ORDER BY used'):
+            self._entries[key] = (size, mtime_ns, digest)
+            self._used = used
+        self._evicted = set()  # Ключи записей, которые нужно удалить из файла
+        self._dirty = set()  # Ключи добавленных и использованных записей: они всегда в конце очереди LRU
+        self._evict()
+
+    def __len__(self):
+        """ Количество записей """
+        return len(self._entries)
+
+    def unchanged(self, file):
+        """ Метод проверяет по размеру и времени изменения, что файл не изменился с прошлой загрузки """
+        key = file_key(file)
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return False  # Недоступный файл не пропускается
+        if entry[:2] != (stat.st_size, stat.st_mtime_ns):
+            return False
+        self._touch(key, entry)
+        return True
+
+    def matches(self, file, digest, size, mtime_ns):
+        """ Метод проверяет, что содержимое файла не изменилось с прошлой загрузки, хотя изменилось время
+         изменения, и запоминает новые размер и время изменения """
+        entry = self._entries.get(file_key(file))
+        if entry is None or entry[2] != digest:
+            return False
+        self.add(file, digest, size, mtime_ns)
+        return True
+
+    def add(self, file, digest, size, mtime_ns):
+        """ Метод запоминает загруженный файл """
+        self._touch(file_key(file), (size, mtime_ns, digest))
+        self._evict()
+
+    def close(self):
+        """ Метод записывает изменения в файл кеша и закрывает его (повторный вызов ничего не делает) """
+        if self._connection is None:
+            return
+        # Использованные записи - последние в очереди LRU, поэтому номера использования продолжают номера в файле
+        dirty = reversed(list(islice(reversed(self._entries.items()), len(self._dirty))))
+        rows = [(key, size, mtime_ns, digest, self._used + used)
+                for used, (key, (size, mtime_ns, digest)) in enumerate(dirty, 1)]
+        with self._connection:
+            self._connection.execute('BEGIN')
+            self._connection.executemany('DELETE FROM entries WHERE key = ?', ((key,) for key in self._evicted))
+            self._connection.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', rows)
+        self._connection.close()
+        self._connection = None
+
+    def _touch(self, key, entry):
+        """ Метод сохраняет запись и переносит её в конец очереди LRU """
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self._dirty.add(key)
+        self._evicted.discard(key)
+
+    def _evict(self):
+        """ Метод вытесняет давно использованные записи сверх max_entries """
+        while len(self._entries) > self.max_entries:
+            key, _ = self._entries.popitem(last=False)
+            self._dirty.discard(key)
+            self._evicted.add(key)
+
+
+class Deduplicator:
+    """ Пропуск повторной загрузки по кешу (UploadCache): файлы, не изменившиеся по размеру и времени изменения,
+     пропускаются без чтения, а для остальных решение принимается по хешу содержимого. Файл пропускается, если
+     содержимое не изменилось или такое же содержимое уже загружено при этом запуске; если файл с таким
+     содержимым ещё загружается, файл ждёт окончания его загрузки. Загруженные файлы запоминаются в кеше """
+
+    def __init__(self, cache):
+        self.cache = cache  # Кеш загруженных файлов
+        self._contents = {}  # Позиция загружаемого файла -> (хеш содержимого, размер, mtime_ns)
+        self._uploading = {}  # Хеш загружаемого содержимого -> ожидающие файлы: (позиция, имя файла, часть)
+        self._uploaded = set()  # Хеши содержимого, загруженного при этом запуске
+
+    def unchanged(self, file):
+        """ Метод проверяет по размеру и времени изменения, что файл не изменился с прошлой загрузки """
+        return self.cache.unchanged(file)
+
+    def hashed(self, index, report):
+        """ Метод принимает отчёт о вычислении хеша и возвращает решение: 'skip', 'wait' или 'upload' """
+        if report.status != 'done':
+            return 'upload'  # Хеш вычислить не удалось: файл загружается как обычно
+
+        digest, size, mtime_ns = report.content
+        if digest in self._uploaded:  # Повтор: файл запоминается, чтобы в следующий раз не читать его
+            self.cache.add(report.filename, digest, size, mtime_ns)
+            return 'skip'
+        if self.cache.matches(report.filename, digest, size, mtime_ns):
+            return 'skip'
+        if digest in self._uploading:
+            self._uploading[digest].append((index, report.filename, report.part))
+            return 'wait'  # Такое же содержимое ещё загружается: решение после его итогового отчёта
+        self._uploading[digest] = []
+        self._contents[index] = report.content
+        return 'upload'
+
+    def settle(self, index, report):
+        """ Метод принимает итоговый отчёт о файле, запоминает в кеше загруженный файл и возвращает файлы
+         с таким же содержимым, которые ждали окончания его загрузки: (позиция, имя файла, часть) """
+        content = self._contents.pop(index, None)
+        if content is None:
+            return []
+
+        digest, size, mtime_ns = content
+        if report.status == 'done':
+            self._uploaded.add(digest)
+            self.cache.add(report.filename, digest, size, mtime_ns)
+        report.content = content
+        return self._uploading.pop(digest)
@@ -0,0 +1,67 @@
+from statistics import median
+from time import monotonic
+
+RESOLUTION = 0.001  # Рост задержки меньше этого значения, с, не считается перегрузкой
+
+
+class ConcurrencyController:
+    """ Автоподбор числа одновременных загрузок по алгоритму AIMD: отчёты о завершённых загрузках собираются
+     в окна размером с текущий предел (примерно один круг всех активных воркеров). Если в окне доля ошибок больше
+     error_rate или медианная задержка больше минимальной наблюдавшейся в tolerance раз, предел уменьшается
+     в decrease раз, иначе увеличивается на единицу. Предел всегда остаётся в границах [minimum, maximum],
+     а каждое его изменение записывается в trace: (секунд от начала, предел) """
+
+    def __init__(self, initial, minimum=1, maximum=None, tolerance=2.0, error_rate=0.1, decrease=0.5):
+        maximum = initial if maximum is None else maximum
+        if not 1 <= minimum <= maximum:
+            raise ValueError(f'Invalid concurrency bounds: {minimum!r}..{maximum!r}')
+
+        self.minimum = minimum  # Наименьшее число одновременных загрузок
+        self.maximum = maximum  # Наибольшее число одновременных загрузок
+        self.tolerance = tolerance  # Допустимый рост задержки относительно наименьшей наблюдавшейся
+        self.error_rate = error_rate  # Допустимая доля ошибок в окне
+        self.decrease = decrease  # Множитель уменьшения предела
+
+        self.limit = min(max(initial, minimum), maximum)  # Текущий предел одновременных загрузок
+        self.trace = [(0.0, self.limit)]  # История изменений предела
+
+        self._started_at = monotonic()
+        self._baseline = None  # Наименьшая медианная задержка окна, с
+        self._observed = 0  # Отчёты в текущем окне
+        self._latencies = []  # Задержки загрузок текущего окна
+        self._errors = 0  # Ошибки в текущем окне
+
+    def observe(self, report):
+        """ Метод учитывает отчёт о завершённой попытке загрузки и возвращает True, если предел изменился """
+        self._observed += 1
+        if report.started_at is not None and report.finished_at is not None:
+            self._latencies.append(report.finished_at - report.started_at)
+        if report.status == 'error':
+            self._errors += 1
+
+        if self._observed < self.limit:
+            return False
+        return self._adjust()
+
+    def _adjust(self):
+        """ Метод пересчитывает предел по итогам окна """
+        errors = self._errors / self._observed
+        latency = median(self._latencies) if self._latencies else None
+        self._observed = 0
+        self._latencies = []
+        self._errors = 0
+
+        if latency is not None and (self._baseline is None or latency < self._baseline):
+            self._baseline = latency
+
+        overloaded = latency is not None and latency > self._baseline * self.tolerance + RESOLUTION
+        if errors > self.error_rate or overloaded:
+            limit = max(self.minimum, int(self.limit * self.decrease))
+        else:
+            limit = min(self.maximum, self.limit + 1)
+
+        if limit == self.limit:
+            return False
+        self.limit = limit
+        self.trace.append((monotonic() - self._started_at, limit))
+        return True
@@ -0,0 +1,75 @@
+import threading
+from multiprocessing import Value
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing.util import Finalize, register_after_fork
+
+
+class ProgressCounters:
+    """ Счётчики прогресса без блокировок на каждый файл: каждый воркер (процесс или поток) пишет только
+     в свою ячейку в общей памяти, а итоговые значения получаются суммированием ячеек при чтении """
+
+    FIELDS = ('processed', 'errors')  # Счётчики в каждой ячейке
+
+    def __init__(self, slots, name=None, next_slot=None):
+        """ Создаёт счётчики на заданное количество ячеек; name и next_slot используются при передаче
+         счётчиков другим процессам """
+        self.slots = slots  # Количество ячеек (по одной на воркер)
+        size = slots * len(self.FIELDS) * 8
+
+        self._owner = name is None  # Только создатель удаляет общую память
+        self._shm = SharedMemory(name=name, create=self._owner, size=size)
+        self._values = self._shm.buf[:size].cast('q')
+        self._released = False
+
+        # Номер следующей свободной ячейки: блокировка берётся один раз при первом обращении воркера
+        self._next_slot = Value('i', 0) if next_slot is None else next_slot
+        self._local = threading.local()
+        register_after_fork(self, ProgressCounters._after_fork)
+        if not self._owner:
+            # Воркеры, запущенные через spawn, завершаются обычным выходом из интерпретатора: отключаемся
+            # от общей памяти заранее, иначе SharedMemory не сможет закрыться из-за открытого представления
+            Finalize(self, _detach, (self._values, self._shm), exitpriority=0)
+
+    def __reduce__(self):
+        return self.__class__, (self.slots, self._shm.name, self._next_slot)
+
+    def add(self, processed=0, errors=0):
+        """ Метод увеличивает счётчики в ячейке текущего воркера """
+        base = self._slot() * len(self.FIELDS)
+        self._values[base] += processed
+        self._values[base + 1] += errors
+
+    def totals(self):
+        """ Метод возвращает суммарные значения счётчиков: (обработано, ошибок) """
+        values = self._values
+        return sum(values[0::2]), sum(values[1::2])
+
+    def release(self):
+        """ Метод отключается от общей памяти, а у создателя ещё и удаляет её (повторный вызов ничего не делает) """
+        if self._released:
+            return
+        self._released = True
+        self._values.release()
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    def _slot(self):
+        """ Метод возвращает номер ячейки текущего воркера, выделяя её при первом обращении """
+        slot = getattr(self._local, 'slot', None)
+        if slot is None:
+            with self._next_slot.get_lock():
+                slot = self._next_slot.value % self.slots
+                self._next_slot.value += 1
+            self._local.slot = slot
+        return slot
+
+    def _after_fork(self):
+        """ Дочерний процесс не должен писать в ячейку родителя """
+        self._local = threading.local()
+
+
+def _detach(values, shm):
+    """ Функция отключает процесс от общей памяти счётчиков """
+    values.release()
+    shm.close()
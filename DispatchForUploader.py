@@ -0,0 +1,345 @@
+import heapq
+import os
+import threading
+from itertools import count
+from random import random
+from time import monotonic
+
+from ResultsForUploader import SKIPPED
+
+# Виды задач: загрузка файла (или его части) и вычисление хеша содержимого перед загрузкой
+UPLOAD = 'upload'
+HASH = 'hash'
+
+
+def file_size(file):
+    """ Функция возвращает размер файла по данным файловой системы (0 для недоступного файла) """
+    try:
+        return os.stat(file).st_size
+    except OSError:
+        return 0  # Ошибка доступа проявится при загрузке
+
+
+def stat_sizes(files):
+    """ Функция возвращает размеры файлов по данным файловой системы (0 для недоступных файлов) """
+    return [file_size(file) for file in files]
+
+
+def walk_files(root, follow_symlinks=False):
+    """ Генератор путей ко всем файлам в каталоге и его подкаталогах: обход через os.scandir без построения
+     списка, поэтому первые файлы выдаются сразу. Недоступные каталоги пропускаются """
+    directories = [root]
+    while directories:
+        try:
+            entries = os.scandir(directories.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=follow_symlinks):
+                        directories.append(entry.path)
+                    elif entry.is_file(follow_symlinks=follow_symlinks):
+                        yield entry.path
+                except OSError:
+                    continue
+
+
+def is_part(part):
+    """ Функция проверяет, что задача - часть файла, а не файл целиком """
+    return part is not None and part[1] != part[2]
+
+
+def _split(size, part_size):
+    """ Генератор частей файла: (смещение, длина, размер файла) """
+    if not part_size or size <= part_size:
+        yield 0, size, size
+        return
+    for offset in range(0, size, part_size):
+        yield offset, min(part_size, size - offset), size
+
+
+def _largest_first(tasks):
+    """ Генератор задач от крупных к мелким: все задачи читаются при первом обращении, а не при создании """
+    yield from sorted(tasks, key=lambda task: -task[4][1])  # Сортировка устойчивая: равные остаются по порядку
+
+
+class Dispatcher:
+    """ Очередь раздачи задач (позиция, файл, вид задачи, попытка, часть) воркерам с повторными попытками """
+
+    def __init__(self, files, store, *, max_attempts=1, backoff=0.1, backoff_max=10.0, jitter=0.5, sizes=None,
+                 largest_first=False, part_size=None, controller=None, metrics=None, journal=None, dedup=None,
+                 on_finished=None):
+        self.max_attempts = max_attempts  # Максимальное количество попыток загрузки одного файла
+        self.backoff = backoff  # Задержка перед второй попыткой, с; далее удваивается с каждой попыткой
+        self.backoff_max = backoff_max  # Максимальная задержка между попытками, с
+        self.jitter = jitter  # Доля задержки, которая случайным образом вычитается, чтобы разнести повторы
+
+        self.part_size = part_size  # Размер части, на которые делятся крупные файлы (None - не делить)
+        self.largest_first = largest_first  # Сначала раздавать самые крупные задачи
+        self.controller = controller  # Автоподбор числа одновременных загрузок (None - без ограничения)
+        self.metrics = metrics  # Показатели загрузки
+        self.dedup = dedup  # Пропуск повторной загрузки (None - загружать все файлы)
+        self.on_finished = on_finished  # Вызывается один раз, когда раздача закончилась и все отчёты обработаны
+        self.retries = 0  # Количество поставленных повторных попыток
+        self.resumed = 0  # Количество файлов, пропущенных по журналу
+        self.unchanged = 0  # Количество файлов, пропущенных по кешу без вычисления хеша
+        self.error = None  # Ошибка чтения входных данных: новые задачи после неё не выдаются
+
+        self._store = store  # Хранилище состояний файлов
+        self._journal = journal  # Журнал загрузок прошлых запусков
+        self._exhausted = False  # Новые задачи закончились
+        self._retries = []  # Куча повторных попыток: (время готовности, задача)
+        self._ready = []  # Куча готовых задач после вычисления хеша: (-размер части или 0, номер, задача)
+        self._sequence = count()  # Номера готовых задач: одинаковые по размеру раздаются в порядке постановки
+        self._parts = {}  # Позиция файла -> [осталось частей, отправлено байт, отчёт об ошибке] для делимых файлов
+        self._in_flight = 0  # Количество выданных и ещё не завершённых задач
+        self._settling = 0  # Количество отчётов, принятых done(), но ещё не обработанных вызвавшим (settled())
+        self._enqueued = {}  # (позиция, часть файла) -> время выдачи для выполняющихся задач
+        self._stopped = False
+        self._finished = False  # on_finished уже вызван
+        self._condition = threading.Condition()
+        self._next = None  # Следующая новая задача
+        self._reading = False  # Входные данные читаются без блокировки
+        # Новые задачи: (позиция в списке, имя файла, вид задачи, номер попытки, часть файла); входные данные
+        # читаются только при раздаче
+        self._tasks = self._plan(files, sizes, largest_first)
+
+    def __iter__(self):
+        """ Блокирующий генератор задач по одной """
+        for batch in self.batches():
+            yield batch[0]
+
+    def batches(self, size=1):
+        """ Блокирующий генератор пачек задач для пулов процессов и потоков: ждёт повторных попыток и завершения
+         выданных задач и заканчивается, когда загружать больше нечего или раздача остановлена.
+         Пачка дополняется только уже доступными задачами, чтобы готовая задача не ждала остальных """
+        while True:
+            with self._condition:
+                task, wait = self._poll()
+                while task is None and wait != 0:
+                    self._condition.wait(wait)
+                    task, wait = self._poll()
+                if task is None:
+                    return
+
+                batch = [task]
+                while len(batch) < size:
+                    task, _ = self._poll()
+                    if task is None:
+                        break
+                    batch.append(task)
+
+            yield batch  # Блокировка не удерживается, пока задачи передают воркерам
+
+    def poll(self):
+        """ Неблокирующий вариант получения задачи: возвращает (задача, None), либо (None, время ожидания в секундах
+         или None, если ждать нужно завершения выданных задач), либо (None, 0), когда раздача окончена """
+        with self._condition:
+            return self._poll()
+
+    @property
+    def in_flight(self):
+        """ Количество выданных и ещё не завершённых задач """
+        return self._in_flight
+
+    @property
+    def finished(self):
+        """ Все задачи выданы и завершены, повторных попыток не осталось """
+        with self._condition:
+            return self._exhausted and not self._in_flight and not self._retries and not self._ready
+
+    def done(self, index, report):
+        """ Метод принимает отчёт о задаче с заданной позицией в списке и возвращает итоговый отчёт о файле либо None,
+         если файл поставлен на повторную попытку или ещё загружаются другие его части """
+        with self._condition:
+            self._in_flight -= 1
+            self._settling += 1
+            self._condition.notify_all()
+            report.enqueued_at = self._enqueued.pop((index, report.part), None)
+            if report.kind == HASH:  # Вычислен хеш содержимого: в показатели загрузки не попадает
+                return self._hashed(index, report)
+            if self.controller is not None:
+                self.controller.observe(report)
+            if self.metrics is not None:
+                self.metrics.observe(report)
+
+            if report.status == 'error' and report.attempt < self.max_attempts and not self._stopped:
+                delay = min(self.backoff_max, self.backoff * 2 ** (report.attempt - 1))
+                delay *= 1 - self.jitter * random()
+                self._push(monotonic() + delay, index, report.filename, UPLOAD, report.attempt + 1, report.part)
+                self.retries += 1
+                if not is_part(report.part):  # Остальные части файла могут ещё загружаться
+                    self._store.requeue(index)
+                return None
+
+            if not is_part(report.part):
+                return self._settle(index, report)
+
+            # Итоговый отчёт о файле, загруженном частями: первая ошибка или последняя часть с суммой байт
+            parts = self._parts[index]
+            parts[0] -= 1
+            parts[1] += report.bytes_sent
+            if report.status == 'error' and parts[2] is None:
+                parts[2] = report
+            if parts[0]:
+                return None
+
+            del self._parts[index]
+            report = parts[2] or report
+            report.bytes_sent = parts[1]
+            return self._settle(index, report)
+
+    def settled(self):
+        """ Метод отмечает, что отчёт, полученный из done(), обработан: последний из них вызывает on_finished """
+        with self._condition:
+            self._settling -= 1
+            self._check_finished()
+
+    def stop(self):
+        """ Метод прекращает раздачу задач """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def _poll(self):
+        """ Выбор следующей задачи: вызывается под блокировкой """
+        if self._stopped:
+            return None, 0
+        if self.controller is not None and self._in_flight >= self.controller.limit:
+            return None, None  # Ждём завершения выданных задач
+
+        # Готовые задачи и повторные попытки идут раньше новых файлов: они занимают лишь по одному месту,
+        # поэтому новые файлы не задерживают
+        if self._ready:
+            return self._issue(*heapq.heappop(self._ready)[2]), None
+        if self._retries and self._retries[0][0] <= monotonic():
+            return self._issue(*heapq.heappop(self._retries)[1]), None
+
+        if not self._exhausted:
+            if self._next is None:
+                if self._reading:
+                    return None, None  # Входные данные читает другой поток
+                self._advance()
+                return self._poll()  # Пока блокировка была отпущена, состояние могло измениться
+            task, self._next = self._next, None
+            return self._issue(*task), None
+
+        if self._retries:
+            return None, max(self._retries[0][0] - monotonic(), 0.001)
+        if self._in_flight:
+            return None, None
+        return None, 0
+
+    def _advance(self):
+        """ Чтение следующей новой задачи без блокировки, чтобы пропуск файлов по журналу и кешу не задерживал
+         done(): ошибка чтения заканчивает новые задачи. Вызывается под блокировкой """
+        self._reading = True
+        self._condition.release()
+        try:
+            task = next(self._tasks, None)
+        except Exception as error:
+            task = None
+            self.error = error
+        finally:
+            self._condition.acquire()
+            self._reading = False
+        self._next = task
+        self._exhausted = task is None
+        self._condition.notify_all()
+        self._check_finished()
+
+    def _check_finished(self):
+        """ Вызов on_finished, когда раздача закончилась и все отчёты обработаны: вызывается под блокировкой """
+        if self._finished or self._settling or self._stopped or not self.finished:
+            return
+        self._finished = True
+        if self.on_finished is not None:
+            self.on_finished()
+
+    def _issue(self, index, file, kind, attempt, part):
+        """ Выдача задачи: вызывается под блокировкой """
+        self._in_flight += 1
+        self._enqueued[index, part] = monotonic()
+        self._store.dispatch(index)
+        return index, file, kind, attempt, part
+
+    def _push(self, ready_at, index, file, kind, attempt, part):
+        """ Постановка задачи в кучу повторных попыток: вызывается под блокировкой """
+        heapq.heappush(self._retries, (ready_at, (index, file, kind, attempt, part)))
+
+    def _push_ready(self, index, file, kind, part):
+        """ Постановка готовой задачи: при largest_first крупные раньше. Вызывается под блокировкой """
+        size = -part[1] if self.largest_first and part is not None else 0
+        heapq.heappush(self._ready, (size, next(self._sequence), (index, file, kind, 1, part)))
+
+    def _plan(self, files, sizes, largest_first):
+        """ Метод возвращает итератор новых задач: без размеров файлы раздаются по списку без копирования.
+         С кешем каждому файлу сначала выдаётся задача вычисления хеша, а на части он делится после неё """
+        kind = UPLOAD if self.dedup is None else HASH
+        if sizes is None:
+            return ((index, file, kind, 1, None) for index, file in self._rows(files))
+
+        if sizes == 'stat':
+            sized = ((index, file, file_size(file)) for index, file in self._rows(files))
+        else:
+            sized = ((index, file, sizes[index]) for index, file in self._rows(files))
+        if self.dedup is None:
+            tasks = ((index, file, UPLOAD, 1, part) for index, file, size in sized
+                     for part in self._split(index, file, size))
+        else:
+            tasks = ((index, file, HASH, 1, (0, size, size)) for index, file, size in sized)
+        if largest_first:
+            return _largest_first(tasks)
+        return tasks
+
+    def _rows(self, files):
+        """ Генератор файлов из входных данных: (позиция, имя файла) без загруженных при прошлых запусках
+         и не изменившихся с прошлой загрузки """
+        for file in files:
+            index = self._store.add(file)
+            if self._journal is not None and self._journal.is_done(file):
+                self._store.complete(index)
+                self.resumed += 1
+                continue
+            if self.dedup is not None and self.dedup.unchanged(file):
+                self._store.complete(index, SKIPPED)
+                self.unchanged += 1
+                continue
+            yield index, file
+
+    def _split(self, index, file, size):
+        """ Метод возвращает части файла, которые нужно загрузить, и запоминает их количество """
+        parts = list(_split(size, self.part_size))
+        if len(parts) == 1:
+            return parts
+
+        if self._journal is not None:
+            # Часть, которая завершает загрузку файла, в журнал не записывается (вместо неё записывается весь
+            # файл), поэтому хотя бы одна часть всегда остаётся
+            parts = [part for part in parts if not self._journal.part_done(file, part[0])] or parts[-1:]
+        self._parts[index] = [len(parts), 0, None]
+        return parts
+
+    def _hashed(self, index, report):
+        """ Метод принимает отчёт о вычислении хеша содержимого и возвращает итоговый отчёт о пропущенном файле
+         либо None, если файл поставлен на загрузку или ждёт загрузки файла с таким же содержимым:
+         вызывается под блокировкой """
+        decision = self.dedup.hashed(index, report)
+        if decision == 'skip':
+            report.status = 'skipped'
+            return report
+        if decision == 'upload':
+            # Загрузка выдаётся раньше новых файлов
+            part = report.part
+            for part in [None] if part is None else self._split(index, report.filename, part[2]):
+                self._push_ready(index, report.filename, UPLOAD, part)
+        return None
+
+    def _settle(self, index, report):
+        """ Метод принимает итоговый отчёт о файле и возвращает в очередь вычисление хеша для файлов с таким же
+         содержимым, которые ждали окончания его загрузки: вызывается под блокировкой """
+        if self.dedup is not None:
+            for waiting, file, part in self.dedup.settle(index, report):
+                self._push_ready(waiting, file, HASH, part)
+        return report
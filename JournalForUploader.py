@@ -0,0 +1,97 @@
+import sqlite3
+import threading
+from hashlib import blake2b
+from time import monotonic
+
+
+def file_key(file):
+    """ Функция возвращает ключ файла в журнале: 64-битный хеш пути, который помещается в целочисленный
+     первичный ключ SQLite, поэтому журнал на миллионы файлов занимает мало места и быстро загружается """
+    digest = blake2b(str(file).encode('utf-8', 'surrogateescape'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+class Journal:
+    """ Журнал завершённых загрузок в SQLite в режиме WAL: записи только добавляются, а фиксируются (с fsync)
+     пачками - когда накопится batch_size записей или пройдёт interval секунд с прошлой фиксации. Хранятся
+     загруженные файлы и смещения загруженных частей крупных файлов; части файла удаляются из журнала, когда
+     загружен весь файл. При открытии ключи загруженных файлов читаются в память одним запросом.
+     После сбоя теряются только нефиксированные записи, и такие файлы (части) загружаются повторно """
+
+    def __init__(self, path, batch_size=10000, interval=1.0):
+        self.path = path  # Путь к файлу журнала
+        self.batch_size = batch_size  # Максимальное количество нефиксированных записей
+        self.interval = interval  # Максимальная задержка фиксации записей, с
+
+        # Записи добавляет основной процесс из потока, который принимает результаты воркеров
+        self._connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=FULL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS files (key INTEGER PRIMARY KEY)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS parts (key INTEGER, offset INTEGER, '
+                                 'PRIMARY KEY (key, offset)) WITHOUT ROWID')
+
+        self._files = {key for key, in self._connection.execute('SELECT key FROM files')}  # Загруженные файлы
+        self._parts = {}  # Ключ файла -> смещения загруженных частей
+        for key, offset in self._connection.execute('SELECT key, offset FROM parts'):
+            self._parts.setdefault(key, set()).add(offset)
+
+        self._pending_files = []  # Нефиксированные записи о файлах
+        self._pending_parts = []  # Нефиксированные записи о частях: (ключ файла, смещение)
+        self._pending_deletes = []  # Файлы, части которых больше не нужны
+        self._flushed_at = monotonic()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """ Количество загруженных файлов """
+        return len(self._files)
+
+    def is_done(self, file):
+        """ Метод проверяет, загружен ли файл """
+        return file_key(file) in self._files
+
+    def part_done(self, file, offset):
+        """ Метод проверяет, загружена ли часть файла с заданным смещением """
+        return offset in self._parts.get(file_key(file), ())
+
+    def record(self, file, offset=None):
+        """ Метод записывает загруженный файл или, если задано смещение, загруженную часть файла """
+        key = file_key(file)
+        with self._lock:
+            if offset is None:
+                self._files.add(key)
+                self._pending_files.append((key,))
+                if self._parts.pop(key, None) is not None:
+                    self._pending_deletes.append((key,))
+            else:
+                self._parts.setdefault(key, set()).add(offset)
+                self._pending_parts.append((key, offset))
+
+            if len(self._pending_files) + len(self._pending_parts) >= self.batch_size or \
+                    monotonic() - self._flushed_at >= self.interval:
+                self._flush()
+
+    def flush(self):
+        """ Метод немедленно фиксирует накопленные записи """
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """ Метод фиксирует накопленные записи и закрывает журнал """
+        with self._lock:
+            self._flush()
+            self._connection.close()
+
+    def _flush(self):
+        """ Фиксация накопленных записей одной транзакцией: вызывается под блокировкой """
+        if self._pending_files or self._pending_parts:
+            with self._connection:
+                self._connection.execute('BEGIN')
+                self._connection.executemany('INSERT OR IGNORE INTO parts VALUES (?, ?)', self._pending_parts)
+                # Ключи вставляются по порядку, чтобы не перестраивать страницы индекса вразнобой
+                self._connection.executemany('INSERT OR IGNORE INTO files VALUES (?)', sorted(self._pending_files))
+                self._connection.executemany('DELETE FROM parts WHERE key = ?', self._pending_deletes)
+            self._pending_files = []
+            self._pending_parts = []
+            self._pending_deletes = []
+        self._flushed_at = monotonic()
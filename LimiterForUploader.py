@@ -0,0 +1,41 @@
+from multiprocessing import Lock, RawArray
+from time import monotonic, sleep
+
+
+class RateLimiter:
+    """ Ограничитель скорости по алгоритму маркерной корзины, общий для всех воркеров (процессов и потоков):
+     состояние корзины хранится в общей памяти, а блокировка удерживается только на время пересчёта маркеров.
+     Запрос забирает маркеры сразу, даже если их не хватает, и ждёт уже вне блокировки, пока долг не покроется,
+     поэтому порции больше ёмкости корзины тоже пропускаются с нужной средней скоростью """
+
+    def __init__(self, rate, burst=None, state=None, lock=None):
+        """ Создаёт ограничитель на rate единиц в секунду с ёмкостью корзины burst (по умолчанию - секунда работы
+         на полной скорости); state и lock используются при передаче ограничителя другим процессам """
+        if rate <= 0:
+            raise ValueError(f'Rate must be positive: {rate!r}')
+
+        self.rate = rate  # Единиц (байт, загрузок) в секунду
+        self.burst = rate if burst is None else burst  # Ёмкость корзины
+
+        # Маркеры в корзине и время последнего пересчёта; корзина изначально полная
+        self._state = RawArray('d', (self.burst, monotonic())) if state is None else state
+        self._lock = Lock() if lock is None else lock
+
+    def __reduce__(self):
+        return self.__class__, (self.rate, self.burst, self._state, self._lock)
+
+    def reserve(self, amount=1):
+        """ Метод забирает маркеры и возвращает время, которое нужно подождать перед использованием, с """
+        with self._lock:
+            now = monotonic()
+            tokens, updated_at = self._state
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate) - amount
+            self._state[0] = tokens
+            self._state[1] = now
+        return -tokens / self.rate if tokens < 0 else 0.0
+
+    def acquire(self, amount=1):
+        """ Метод блокирует воркер, пока не наберётся нужное количество маркеров """
+        delay = self.reserve(amount)
+        if delay:
+            sleep(delay)
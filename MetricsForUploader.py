@@ -0,0 +1,169 @@
+import json
+import threading
+from bisect import bisect_left
+from collections import deque
+from time import monotonic
+
+# Границы корзин гистограмм времени, с (как у клиентов Prometheus по умолчанию)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class Histogram:
+    """ Гистограмма с фиксированными границами корзин: хранит только количество значений в каждой корзине,
+     поэтому память не зависит от количества файлов, а квантили оцениваются по верхней границе корзины """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets  # Верхние границы корзин (включительно), последняя - бесконечность
+        self.counts = [0] * len(buckets)  # Количество значений в каждой корзине
+        self.count = 0  # Общее количество значений
+        self.sum = 0.0  # Сумма значений
+
+    def observe(self, value):
+        """ Метод учитывает очередное значение """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """ Метод возвращает оценку квантиля q (0-1): верхнюю границу корзины, в которую он попадает """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def snapshot(self):
+        """ Метод возвращает состояние гистограммы: накопительные значения корзин, как в Prometheus """
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': buckets,
+        }
+
+
+class UploadMetrics:
+    """ Скользящие показатели загрузки по отчётам о каждой попытке: гистограммы времени ожидания в очереди,
+     самой загрузки и общего времени, количество попыток по статусам, переданные байты, скорость за последние
+     window секунд и время работы каждого воркера (по PID), чтобы находить медленные воркеры """
+
+    LATENCIES = ('queue_wait', 'upload', 'total')  # Гистограммы времени
+
+    def __init__(self, window=10.0):
+        self.window = window  # Окно расчёта скорости, с
+
+        self.histograms = {name: Histogram() for name in self.LATENCIES}
+        self.attempts = {'done': 0, 'error': 0}  # Количество попыток по итоговому статусу попытки
+        self.bytes_sent = 0  # Всего переданных байт
+        self.workers = {}  # (PID, поток) воркера -> [количество попыток, суммарное время загрузки, с]
+
+        self._started_at = monotonic()
+        self._rate = deque()  # Скорость по секундам: [секунда, попыток, байт]
+        self._lock = threading.Lock()
+
+    def observe(self, report):
+        """ Метод учитывает отчёт о завершённой попытке загрузки """
+        with self._lock:
+            self.attempts[report.status] = self.attempts.get(report.status, 0) + 1
+            self.bytes_sent += report.bytes_sent
+
+            if report.started_at is not None and report.finished_at is not None:
+                upload = report.finished_at - report.started_at
+                self.histograms['upload'].observe(upload)
+                if report.enqueued_at is not None:
+                    self.histograms['queue_wait'].observe(max(report.started_at - report.enqueued_at, 0.0))
+                    self.histograms['total'].observe(report.finished_at - report.enqueued_at)
+
+                worker = self.workers.setdefault((report.worker_pid, report.worker_thread), [0, 0.0])
+                worker[0] += 1
+                worker[1] += upload
+
+            second = int(report.finished_at if report.finished_at is not None else monotonic())
+            if self._rate and self._rate[-1][0] == second:
+                self._rate[-1][1] += 1
+                self._rate[-1][2] += report.bytes_sent
+            else:
+                self._rate.append([second, 1, report.bytes_sent])
+            self._expire(second)
+
+    def snapshot(self, in_flight=0):
+        """ Метод возвращает текущие показатели словарём, готовым к сериализации в JSON """
+        with self._lock:
+            now = monotonic()
+            self._expire(int(now))
+            span = min(self.window, now - self._started_at) or None
+            files = sum(count for _, count, _ in self._rate)
+            sent = sum(sent for _, _, sent in self._rate)
+            return {
+                'elapsed': now - self._started_at,
+                'in_flight': in_flight,
+                'attempts': dict(self.attempts),
+                'bytes_sent': self.bytes_sent,
+                'files_per_second': files / span if span else 0.0,
+                'bytes_per_second': sent / span if span else 0.0,
+                'latency': {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+                'workers': {f'{pid}:{thread}': {'pid': pid, 'thread': thread, 'uploads': count, 'seconds': seconds}
+                            for (pid, thread), (count, seconds) in self.workers.items()},
+            }
+
+    def _expire(self, second):
+        """ Удаление секунд, вышедших за окно расчёта скорости: вызывается под блокировкой """
+        while self._rate and self._rate[0][0] <= second - self.window:
+            self._rate.popleft()
+
+
+def to_json(snapshot):
+    """ Функция сериализует показатели в JSON (бесконечная граница корзины записывается строкой '+Inf') """
+    snapshot = dict(snapshot, latency={
+        name: dict(histogram, buckets=[(_format_bound(bound), count) for bound, count in histogram['buckets']])
+        for name, histogram in snapshot['latency'].items()})
+    return json.dumps(snapshot)
+
+
+def to_prometheus(snapshot, prefix='uploader'):
+    """ Функция записывает показатели в текстовом формате Prometheus (подходит, например, для textfile
+     collector node_exporter) """
+    lines = [
+        f'# TYPE {prefix}_in_flight gauge',
+        f'{prefix}_in_flight {snapshot["in_flight"]}',
+        f'# TYPE {prefix}_attempts_total counter',
+    ]
+    lines += [f'{prefix}_attempts_total{{status="{status}"}} {count}'
+              for status, count in snapshot['attempts'].items()]
+    lines += [
+        f'# TYPE {prefix}_bytes_sent_total counter',
+        f'{prefix}_bytes_sent_total {snapshot["bytes_sent"]}',
+        f'# TYPE {prefix}_files_per_second gauge',
+        f'{prefix}_files_per_second {snapshot["files_per_second"]}',
+        f'# TYPE {prefix}_bytes_per_second gauge',
+        f'{prefix}_bytes_per_second {snapshot["bytes_per_second"]}',
+    ]
+
+    for name, histogram in snapshot['latency'].items():
+        metric = f'{prefix}_{name}_seconds'
+        lines.append(f'# TYPE {metric} histogram')
+        lines += [f'{metric}_bucket{{le="{_format_bound(bound)}"}} {count}' for bound, count in histogram['buckets']]
+        lines.append(f'{metric}_sum {histogram["sum"]}')
+        lines.append(f'{metric}_count {histogram["count"]}')
+
+    workers = [(f'pid="{worker["pid"]}",thread="{worker["thread"]}"', worker)
+               for worker in snapshot['workers'].values()]
+    lines.append(f'# TYPE {prefix}_worker_uploads_total counter')
+    lines += [f'{prefix}_worker_uploads_total{{{labels}}} {worker["uploads"]}' for labels, worker in workers]
+    lines.append(f'# TYPE {prefix}_worker_upload_seconds_total counter')
+    lines += [f'{prefix}_worker_upload_seconds_total{{{labels}}} {worker["seconds"]}' for labels, worker in workers]
+    return '\n'.join(lines) + '\n'
+
+
+def _format_bound(bound):
+    """ Граница корзины в формате Prometheus """
+    return '+Inf' if bound == float('inf') else repr(bound)
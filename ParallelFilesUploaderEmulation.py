@@ -1,244 +1,880 @@
-from multiprocessing import Pool, Value
-from random import randint
-from time import sleep
-
+import asyncio
+import os
+import threading
+from collections.abc import Sized
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from multiprocessing import Pool, TimeoutError
+from random import random
+from time import monotonic, sleep
+
+from CacheForUploader import Deduplicator, UploadCache
+from ConcurrencyForUploader import ConcurrencyController
+from CountersForUploader import ProgressCounters
+from DispatchForUploader import HASH, Dispatcher, is_part
+from JournalForUploader import Journal
+from LimiterForUploader import RateLimiter
+from MetricsForUploader import UploadMetrics, to_json, to_prometheus
+from ProgressForUploader import ProgressChannel
 from ReportForUploader import Report
+from ResultsForUploader import ResultStore
+from SinksForUploader import hash_file, stream_file
 
 
 class Uploader:
     """ Класс для имитации загрузки файлов на сервер """
 
+    BACKENDS = ('process', 'thread', 'asyncio')  # Доступные способы параллельной загрузки
+    SCHEDULES = ('fifo', 'largest_first')  # Доступные порядки раздачи файлов
+    METRICS_FORMATS = ('prometheus', 'json')  # Доступные форматы выгрузки показателей
+    # Настройки, которые использует только основной процесс
+    _MAIN_PROCESS_SETTINGS = ('progress_mode', 'progress_batch_size', 'progress_interval', 'metrics_window',
+                              'metrics_hook', 'metrics_interval', '_metrics_published_at', 'journal',
+                              'journal_batch_size', 'journal_interval', 'cache', 'cache_size', 'file_sizes')
+    # Состояние загрузки, которое нужно только основному процессу
+    _MAIN_PROCESS_STATE = ('_unchanged_count', '_started_at', '_finished_at', '_finish_lock', 'metrics_hook_error')
+
     def __init__(self, files_to_upload, threads_count, reports_q):
         """ Инициализация переменных для дальнейшего использования:
-         принимает список файлов для загрузки, количество потоков, очередь для отчётов """
+         принимает список файлов для загрузки (или любой итерируемый объект, например генератор или walk_files),
+         количество потоков, очередь для отчётов """
         self.reports_q = reports_q  # Очередь для отчётов
         self.threads_count = threads_count  # Число параллельных потоков
         self.files_to_upload = files_to_upload  # Список файлов для загрузки
 
-        self.total_count = len(files_to_upload)  # Количество файлов для загрузки
+        # Количество файлов для загрузки: у потока файлов неизвестно (можно задать оценку), а по окончании загрузки
+        # становится точным
+        self.total_count = len(files_to_upload) if isinstance(files_to_upload, Sized) else None
         self.processed_count = 0  # Количество обработанных файлов
         self.uploaded_count = 0  # Количество загруженных файлов
         self.errors_count = 0  # Количество произошедших ошибок загрузки
         self.aborted_count = 0  # Количество отменённых загрузок
+        self.resumed_count = 0  # Количество файлов, загруженных при прошлых запусках (по журналу)
+        self.skipped_count = 0  # Количество файлов, пропущенных по кешу: не изменившихся и повторяющихся
 
-        self.uploaded_files = []  # Загруженные файлы
-        self.error_files = []  # Файлы, которые не удалось загрузить из-за ошибок
-        self.aborted_files = []  # Файлы, которые не удалось загрузить из-за принудительной остановки
-
+        self.backend = 'process'  # Способ параллельной загрузки: пул процессов, пул потоков или корутины asyncio
         self.worker_time = 0.1  # Время имитации нагрузки (загрузки файла)
+        self.emulated_speed = None  # Скорость имитации загрузки, байт/с: если задана и размеры файлов известны,
+        # время имитации пропорционально размеру файла (или его части) вместо worker_time
         self.error_emulation = False  # Включает имитацию случайных ошибок во время загрузки
+        self.error_rate = 1 / 3  # Вероятность имитируемой ошибки при загрузке файла
+        self.retry_attempts = 1  # Максимальное количество попыток загрузки файла (1 - без повторов)
+        self.retry_backoff = 0.1  # Задержка перед второй попыткой, с; далее удваивается с каждой попыткой
+        self.retry_backoff_max = 10.0  # Максимальная задержка между попытками, с
+        self.retry_jitter = 0.5  # Доля задержки, которая случайным образом вычитается, чтобы разнести повторы
+        self.sink = None  # Приёмник данных: если задан, файлы действительно читаются и передаются в него
+        self.chunk_size = 1024 * 1024  # Размер блока, которым читаются файлы
+        self.mmap_threshold = 64 * 1024 * 1024  # Файлы начиная с этого размера читаются через mmap
+        self.bytes_uploaded = 0  # Количество переданных байт
+        self.chunksize = 1  # Количество файлов в одной задаче для пула процессов
+        self.prefetch = 32  # Сколько задач на воркер пулы процессов и потоков получают заранее
+        self.keep_uploaded_files = True  # Хранить имена загруженных файлов для итогового отчёта, если файлы
+        # приходят потоком (False - хранятся только файлы с ошибками и отменённые)
+        self.file_sizes = None  # Размеры (стоимость загрузки) файлов по позициям в списке, 'stat' - взять из
+        # файловой системы, None - неизвестны
+        self.schedule = 'fifo'  # Порядок раздачи: по списку или сначала самые крупные файлы (нужны file_sizes)
+        self.part_size = None  # Файлы крупнее загружаются частями такого размера разными воркерами (нужны file_sizes)
+        self.bytes_per_second = None  # Общее для всех воркеров ограничение скорости передачи, байт/с
+        self.uploads_per_second = None  # Общее для всех воркеров ограничение количества загрузок в секунду
+        self.rate_burst = 0.1  # Допустимый всплеск сверх ограничений скорости: столько секунд работы без ожидания
+        self.adaptive_concurrency = False  # Автоподбор числа одновременных загрузок (начиная с threads_count)
+        # по задержкам и ошибкам загрузок
+        self.concurrency_min = 1  # Наименьшее число одновременных загрузок при автоподборе
+        self.concurrency_max = None  # Наибольшее число одновременных загрузок при автоподборе (None - threads_count)
+        self.concurrency_tolerance = 2.0  # Допустимый рост задержки загрузки относительно наименьшей наблюдавшейся
+        self.concurrency_error_rate = 0.1  # Допустимая доля ошибок, при превышении число загрузок уменьшается
+        self.journal = None  # Путь к журналу загрузок (SQLite): файлы и части файлов, загруженные при прошлых
+        # запусках с тем же журналом, пропускаются
+        self.journal_batch_size = 10000  # Максимальное количество нефиксированных записей журнала
+        self.journal_interval = 1.0  # Максимальная задержка фиксации записей журнала, с
+        self.cache = None  # Путь к кешу загруженных файлов (SQLite, ':memory:' - только на время загрузки):
+        # не изменившиеся с прошлой загрузки файлы и файлы с уже загруженным содержимым пропускаются
+        self.cache_size = 1000000  # Максимальное количество записей в кеше, лишние вытесняются (LRU)
+        self.progress_mode = 'each'  # Режим отправки отчётов в очередь: 'each', 'batch' или 'latest'
+        self.progress_batch_size = 100  # Максимальный размер пачки отчётов в режиме 'batch'
+        self.progress_interval = 0.5  # Максимальная задержка отправки отчётов в режимах 'batch' и 'latest', с
+        self.metrics_window = 10.0  # Окно расчёта скорости в показателях загрузки, с
+        self.metrics_hook = None  # Функция, которой передаются показатели загрузки (словарь, как у metrics())
+        self.metrics_interval = 1.0  # Минимальный интервал вызова metrics_hook, с; по окончании загрузки - всегда
+        self.metrics_hook_error = None  # Последнее исключение metrics_hook: на загрузку оно не влияет
         self.terminated = False  # Флаг определяющий была ли загрузка принудительно прервана методом '.stop()'
         self.busy = False  # Флаг определяющий продолжается ли загрузка файлов
         self._pool = None  # Переменная для хранения пула
-
-        self._result = []  # Сюда попадают отчёты о работе
+        self._counters = None  # Общие для воркеров счётчики прогресса
+        self._dispatcher = None  # Очередь раздачи задач воркерам
+        self._bytes_limiter = None  # Ограничитель скорости передачи (передаётся воркерам вместе с настройками)
+        self._uploads_limiter = None  # Ограничитель количества загрузок
+        self._controller = None  # Автоподбор числа одновременных загрузок
+        self._journal = None  # Журнал загрузок
+        self._cache = None  # Кеш загруженных файлов
+        self._unchanged_count = 0  # Количество файлов, которые очередь раздачи пропустила по кешу
+        self._progress = None  # Канал для отправки отчётов в очередь
+        self._metrics = UploadMetrics(self.metrics_window)  # Показатели загрузки по отчётам о каждой попытке
+        self._metrics_published_at = None  # Время последнего вызова metrics_hook
+        self._started_at = None  # Время начала загрузки
+        self._finished_at = None  # Время окончания загрузки
+        self._finish_lock = threading.Lock()  # Окончание загрузки выполняется один раз
+
+        self._result = ResultStore()  # Сюда попадают отчёты о работе (и состояния файлов во время загрузки)
 
     def start(self):
         """ Активация начала загрузки файлов """
+        if self.backend not in self.BACKENDS:
+            raise ValueError(f'Unknown backend: {self.backend!r}. Available: {", ".join(self.BACKENDS)}')
+        if self.schedule not in self.SCHEDULES:
+            raise ValueError(f'Unknown schedule: {self.schedule!r}. Available: {", ".join(self.SCHEDULES)}')
+        self._check_sizes()
+
+        # Отчёты отправляет в очередь только основной процесс, воркерам она не нужна
+        self._progress = ProgressChannel(self.reports_q, self.progress_mode, self.progress_batch_size,
+                                         self.progress_interval)
+
+        # Состояние каждого файла по его позиции в списке
+        self._result = ResultStore(self.files_to_upload, self.keep_uploaded_files)
+        if self.journal is not None:
+            self._journal = Journal(self.journal, self.journal_batch_size, self.journal_interval)
+        if self.cache is not None:
+            self._cache = UploadCache(self.cache, self.cache_size)
+        self._controller = self._create_controller()
+        self._metrics = UploadMetrics(self.metrics_window)
+        self._metrics_published_at = monotonic()
+        self.metrics_hook_error = None
+        self._dispatcher = Dispatcher(
+            self.files_to_upload, self._result,
+            max_attempts=self.retry_attempts, backoff=self.retry_backoff, backoff_max=self.retry_backoff_max,
+            jitter=self.retry_jitter, sizes=self.file_sizes, largest_first=self.schedule == 'largest_first',
+            part_size=self.part_size, controller=self._controller, metrics=self._metrics, journal=self._journal,
+            dedup=None if self._cache is None else Deduplicator(self._cache), on_finished=self._finish)
+        self._bytes_limiter = self._create_limiter(self.bytes_per_second)
+        self._uploads_limiter = self._create_limiter(self.uploads_per_second)
         self.busy = True
+        self._started_at = monotonic()
+        self._finished_at = None
 
         # Определение переменных для расшаривания между процессами
-        processed_count = Value('i', 0)  # Счётчик количества обработанных файлов
-        errors_count = Value('i', 0)  # Счётчик ошибок
-        start_trigger = Value('i', False)  # Триггер для определения начала работы пула (workaround)
-
-        # Создание пула с функцией инициализации и расшаренными переменными
-        pool = Pool(self.threads_count, initializer=self._initializer, initargs=(self.total_count,
-                                                                                 processed_count,
-                                                                                 errors_count,
-                                                                                 start_trigger))
-        # Задачи для пула принимают файлы для загрузки
-        jobs = []
-        for file in self.files_to_upload:
-            jobs.append(pool.apply_async(self._upload, (file,), callback=self._done))
-
-        pool.close()
-
-        # Ожидаем начало работы пула (Workaround для того, чтобы можно было сделать переменную с экземпляром пула
-        # свойством класса для использования в других методах:
-        while not start_trigger.value:
-            sleep(0.1)
+        self._counters = ProgressCounters(self.workers_count + 1)  # Счётчики обработанных файлов и ошибок
+        initargs = (self, self.total_count, self._counters)
 
-        self._pool = pool
+        # Входные данные читает пул при раздаче задач, он же заканчивает загрузку, если загружать нечего
+        if self.backend == 'process':
+            self._pool = _ProcessPool(self, initargs)
+        else:
+            # Потоки и корутины работают с этим же экземпляром, поэтому глобальные переменные им не нужны
+            self._pool = _ThreadPool(self) if self.backend == 'thread' else _AsyncioPool(self)
 
     def stop(self):
         """ Метод принудительной остановки загрузки """
-        self._pool.terminate()  # Останавливаем пул
-        self._pool.join()  # Дожидаемся его завершения
-
-        self._generate_aborted_reports()  # Создаём отчёты для отменённых файлов
-        self._calc_result()  # Вызываем подсчёт результатов
+        if not self.busy:  # Загрузка уже закончилась (или не начиналась): останавливать нечего
+            self.terminated = True
+            return
 
-        # Устанавливаем флаги состояния
-        self.busy = False
-        self.terminated = True
+        self._dispatcher.stop()  # Прекращаем раздачу задач
+        self._pool.terminate()  # Останавливаем пул
+        try:
+            self._pool.join()  # Дожидаемся его завершения
+        finally:
+            self._abort()
 
     def join(self):
-        """ Метод позволяет дождаться заверешения работы аплоадера """
-        self._pool.join()
+        """ Метод позволяет дождаться заверешения работы аплоадера: если входные данные не удалось прочитать
+         до конца, после окончания загрузки прочитанных файлов выбрасывает ошибку чтения. Ошибка обработки
+         результатов останавливает загрузку и тоже выбрасывается отсюда """
+        try:
+            self._pool.join()
+        except Exception:
+            if self.busy:
+                self._abort()
+            raise
+        if self.input_error is not None:
+            raise self.input_error
 
     def is_active(self):
         """ Метод возвращает текущее состояние аплоадера """
         return self.busy
 
-    def _calc_result(self):
-        """ Метод высчитывает результаты обработанных файлов и сохраняет их в свойства экземпляра """
+    @property
+    def workers_count(self):
+        """ Размер пула: при автоподборе воркеры создаются на наибольшее число одновременных загрузок """
+        if self.adaptive_concurrency and self.concurrency_max is not None:
+            return self.concurrency_max
+        return self.threads_count
 
-        for report in self._result:
-            if report.status == 'done':
-                self.uploaded_files.append(report.filename)
-            elif report.status == 'aborted':
-                self.aborted_files.append(report.filename)
-            else:
-                self.error_files.append(report.filename)
+    @property
+    def concurrency_trace(self):
+        """ История автоподбора: список (секунд от начала загрузки, число одновременных загрузок) """
+        return list(self._controller.trace) if self._controller is not None else []
 
     @property
-    def result(self):
-        """ Метод возвращает итоговый отчёт о проделанной работе """
+    def input_error(self):
+        """ Ошибка чтения входных данных (например, исключение в генераторе файлов) или None """
+        return self._dispatcher.error if self._dispatcher is not None else None
 
-        # Получаем и обрабатываем отчёты о работе из переменной с результатами
-        uploaded = []
-        aborted = []
-        error = []
-        for report in self._result:
-            if report.status == 'done':
-                uploaded.append(f'Filename: {report.filename}, status: {report.status}')
-            elif report.status == 'aborted':
-                aborted.append(f'Filename: {report.filename}, status: {report.status}')
-            else:
-                error.append(f'Filename: {report.filename}, status: {report.status}: {report.error_message}')
-
-        # Просто возвращаем оформленную строку с результатами
-        uploaded_joint = '\n'.join(uploaded)
-        error_joint = '\n'.join(aborted)
-        aborted_joint = '\n'.join(error)
-
-        result = f"\nTotal results:" \
-                 f"\n{'-' * 3}" \
-                 f"\nUploaded files:\n{uploaded_joint}" \
-                 f"\n{'-' * 3}" \
-                 f"\nNot uploaded files:\n{error_joint}\n{aborted_joint}" \
-                 f"\n{'-' * 3}" \
-                 f"\nTotal files: {self.total_count}" \
-                 f"\nDone: {self.uploaded_count}" \
-                 f"\nErrors: {self.errors_count}" \
-                 f"\nAborted: {self.aborted_count}\n"
+    @property
+    def retries_count(self):
+        """ Количество повторных попыток загрузки """
+        return self._dispatcher.retries if self._dispatcher is not None else 0
 
-        if self.terminated:
-            result = '\nWARNING: ABORTED!\n' + result
-        elif self.errors_count:
-            result = '\nWARNING: ERRORS!\n' + result
-        else:
-            result = '\nSuccessfully Completed\n' + result
+    @property
+    def throughput(self):
+        """ Метод возвращает среднюю скорость передачи данных в МБ/с """
+        if self._started_at is None:
+            return 0.0
+        elapsed = (self._finished_at or monotonic()) - self._started_at
+        return self.bytes_uploaded / elapsed / (1024 * 1024) if elapsed else 0.0
+
+    def metrics(self):
+        """ Метод возвращает текущие показатели загрузки: гистограммы времени ожидания в очереди, загрузки
+         и общего времени, количество попыток по статусам, скорость за последние metrics_window секунд,
+         количество выполняющихся загрузок и время работы каждого воркера """
+        in_flight = self._dispatcher.in_flight if self._dispatcher is not None and self.busy else 0
+        return self._metrics.snapshot(in_flight)
+
+    def export_metrics(self, metrics_format='prometheus'):
+        """ Метод возвращает текущие показатели загрузки в текстовом формате Prometheus или в JSON """
+        if metrics_format not in self.METRICS_FORMATS:
+            raise ValueError(f'Unknown metrics format: {metrics_format!r}. '
+                             f'Available: {", ".join(self.METRICS_FORMATS)}')
+        metrics = self.metrics()
+        return to_prometheus(metrics) if metrics_format == 'prometheus' else to_json(metrics)
 
-        return result
+    @property
+    def uploaded_files(self):
+        """ Загруженные файлы """
+        return self._result.filenames('done')
 
-    def _upload(self, file):
-        """ Метод для непосредственной загрузки файлов, который передаётся воркерам:
-         возвращает результат в callback-функцию и в очередь """
-        # Получаем расшаренные между процессами глобальные переменные
-        global START_TRIGGER
-        global PROCESSED_COUNT
-        global ERRORS_COUNT
+    @property
+    def error_files(self):
+        """ Файлы, которые не удалось загрузить из-за ошибок """
+        return self._result.filenames('error')
 
-        # Сообщаем о начале работы воркеров
-        with START_TRIGGER.get_lock():
-            if not START_TRIGGER.value:
-                START_TRIGGER.value = True
+    @property
+    def skipped_files(self):
+        """ Файлы, которые не понадобилось загружать: не изменились с прошлой загрузки или повторяют содержимое
+         загруженных """
+        return self._result.filenames('skipped')
 
-        # Начинаем формирование отчёта
-        report = Report()
-        report.filename = file
-        report.total_count = TOTAL_COUNT
-        report.aborted_count = 0
-        report.status = 'uploading'
+    @property
+    def aborted_files(self):
+        """ Файлы, которые не удалось загрузить из-за принудительной остановки """
+        return self._result.filenames('aborted')
+
+    @property
+    def result(self):
+        """ Метод возвращает итоговый отчёт о проделанной работе """
+        return ''.join(self.iter_result())
+
+    @property
+    def summary(self):
+        """ Метод возвращает краткий итог без списков файлов: счётчики обновляются по мере поступления отчётов,
+         поэтому его можно запрашивать во время загрузки """
+        return self._result_state() + self._result_counts()
+
+    def iter_result(self):
+        """ Генератор возвращает итоговый отчёт по частям, не собирая его целиком в памяти """
+        yield self._result_state()
+        yield f"\nTotal results:" \
+              f"\n{'-' * 3}" \
+              f"\nUploaded files:\n"
+        yield from self._result_lines('done')
+        if self.skipped_count:
+            yield f"\n{'-' * 3}" \
+                  f"\nSkipped files:\n"
+            yield from self._result_lines('skipped')
+        yield f"\n{'-' * 3}" \
+              f"\nNot uploaded files:\n"
+        yield from self._result_lines('error')
+        yield '\n'
+        yield from self._result_lines('aborted')
+        yield f"\n{'-' * 3}"
+        yield self._result_counts()
+
+    def write_to(self, file):
+        """ Метод построчно записывает итоговый отчёт в открытый текстовый файл """
+        for part in self.iter_result():
+            file.write(part)
+
+    def _result_state(self):
+        """ Заголовок итогового отчёта """
+        if self.terminated:
+            return '\nWARNING: ABORTED!\n'
+        elif self.input_error is not None:
+            return f'\nWARNING: INPUT ERROR! {self.input_error!r}\n'
+        elif self.errors_count:
+            return '\nWARNING: ERRORS!\n'
+        return '\nSuccessfully Completed\n'
+
+    def _result_counts(self):
+        """ Счётчики итогового отчёта (пропущенные файлы - только если они есть) """
+        skipped = f"Skipped: {self.skipped_count}\n" if self.skipped_count else ''
+        total_count = '?' if self.total_count is None else self.total_count  # Поток файлов прочитан не до конца
+        return f"\nTotal files: {total_count}" \
+               f"\nDone: {self.uploaded_count}" \
+               f"\nErrors: {self.errors_count}" \
+               f"\nAborted: {self.aborted_count}\n" + skipped
+
+    def _result_lines(self, status):
+        """ Генератор строк итогового отчёта о файлах с заданным статусом, разделённых переводом строки """
+        separator = ''
+        for filename, error_message in self._result.rows(status):
+            if status == 'error':
+                yield f'{separator}Filename: {filename}, status: {status}: {error_message}'
+            else:
+                yield f'{separator}Filename: {filename}, status: {status}'
+            separator = '\n'
+
+    def _execute(self, kind, file, attempt=1, part=None):
+        """ Метод выполнения задачи, который передаётся воркерам: загрузка файла или вычисление хеша
+         его содержимого перед загрузкой """
+        if kind == HASH:
+            return self._hash(file, part)
+        return self._upload(file, attempt, part)
+
+    async def _execute_async(self, kind, file, attempt=1, part=None):
+        """ Асинхронный вариант метода выполнения задачи для бэкенда 'asyncio' """
+        if kind == HASH:
+            return await asyncio.get_running_loop().run_in_executor(None, self._hash, file, part)
+        return await self._upload_async(file, attempt, part)
+
+    def _upload(self, file, attempt=1, part=None):
+        """ Метод для непосредственной загрузки файлов: возвращает результат в callback-функцию """
+        report = self._begin_report(file, attempt, part)
 
         try:
-            # Начало имитации загрузки
+            delay = self._throttle(part)
+            if delay:
+                sleep(delay)
+            report.started_at = monotonic()
+
+            if self.sink is None:
+                # Имитация загрузки
+                sleep(self._emulated_time(part))
+            else:
+                # Реальное чтение файла (или его части) и передача данных в приёмник
+                report.bytes_sent = stream_file(file, self.sink, self.chunk_size, self.mmap_threshold,
+                                                *self._byte_range(part), self._bytes_limiter)
 
-            sleep(self.worker_time)
+            self._emulate_error()
+            self._report_done(report)
 
-            # Имитация ошибки во время загрузки
-            if self.error_emulation:
-                if randint(0, 2) == 1:
-                    raise ValueError('Emulated error')
+        except Exception as error:
+            self._report_error(report, error)
 
-            # "Загрузка" окончена
-            report.status = 'done'
+        finally:
+            return report  # Возвращаем результат для callback-функции
 
-            # Используя блокировки изменяем значения счётчиков
-            with ERRORS_COUNT.get_lock():
-                report.errors_count = ERRORS_COUNT.value
+    async def _upload_async(self, file, attempt=1, part=None):
+        """ Асинхронный вариант метода загрузки для бэкенда 'asyncio' """
+        report = self._begin_report(file, attempt, part)
 
-            with PROCESSED_COUNT.get_lock():
-                PROCESSED_COUNT.value += 1
-                report.processed_count = PROCESSED_COUNT.value
+        try:
+            delay = self._throttle(part)
+            if delay:
+                await asyncio.sleep(delay)
+            report.started_at = monotonic()
+
+            if self.sink is None:
+                # Имитация загрузки без блокировки цикла событий
+                await asyncio.sleep(self._emulated_time(part))
+            else:
+                # Чтение файла блокирующее, поэтому выносится в пул потоков цикла событий
+                loop = asyncio.get_running_loop()
+                report.bytes_sent = await loop.run_in_executor(None, stream_file, file, self.sink,
+                                                               self.chunk_size, self.mmap_threshold,
+                                                               *self._byte_range(part), self._bytes_limiter)
 
-                self.reports_q.put(report)  # Добавляем отчёт в очередь
+            self._emulate_error()
+            self._report_done(report)
 
         except Exception as error:
-            # Сохраняем информацию о возможной ошибке
-            report.status = 'error'
-            report.error_message = error
-
-            # Используя блокировки изменяем значения счётчиков
-            with PROCESSED_COUNT.get_lock():
-                PROCESSED_COUNT.value += 1
-                report.processed_count = PROCESSED_COUNT.value
+            self._report_error(report, error)
 
-            with ERRORS_COUNT.get_lock():
-                ERRORS_COUNT.value += 1
-                report.errors_count = ERRORS_COUNT.value
+        return report
 
-                self.reports_q.put(report)  # Добавляем отчёт в очередь
+    def _hash(self, file, part):
+        """ Метод потоково вычисляет хеш содержимого файла: по отчёту основной процесс решает, нужно ли
+         загружать файл, поэтому счётчики прогресса не меняются """
+        report = self._begin_report(file, 1, part)
+        report.kind = HASH
+        report.started_at = monotonic()
+        try:
+            report.content = hash_file(file, self.chunk_size)
+            report.status = 'done'
+        except OSError as error:
+            report.status = 'error'
+            report.error_message = error
+        report.finished_at = monotonic()
+        return report
 
-        finally:
-            return report  # Возвращаем результат для callback-функции
+    def _begin_report(self, file, attempt, part):
+        """ Метод начинает формирование отчёта """
+        report = Report()
+        report.filename = file
+        report.attempt = attempt
+        report.part = part
+        report.worker_pid = os.getpid()
+        report.worker_thread = threading.get_ident()
+        report.total_count = self.total_count
+        report.aborted_count = 0
+        report.status = 'uploading'
+        return report
+
+    def _check_sizes(self):
+        """ Метод проверяет настройки, которым нужны размеры файлов """
+        if self.file_sizes is None:
+            if self.schedule == 'largest_first':
+                raise ValueError("Schedule 'largest_first' requires file_sizes")
+            if self.part_size:
+                raise ValueError('part_size requires file_sizes')
+            if self.emulated_speed is not None:
+                raise ValueError('emulated_speed requires file_sizes')
+            if self.bytes_per_second and self.sink is None:
+                raise ValueError('bytes_per_second without a sink requires file_sizes')
+        elif self.file_sizes != 'stat':
+            if not isinstance(self.files_to_upload, Sized):
+                raise ValueError("file_sizes list requires a sized list of files, use 'stat' for streamed files")
+            if len(self.file_sizes) != len(self.files_to_upload):
+                raise ValueError(f'file_sizes has {len(self.file_sizes)} items '
+                                 f'for {len(self.files_to_upload)} files')
+
+    def _create_controller(self):
+        """ Метод создаёт автоподбор числа одновременных загрузок, если он включён: начальный предел threads_count
+         ограничивается границами concurrency_min и concurrency_max """
+        if not self.adaptive_concurrency:
+            return None
+        return ConcurrencyController(self.threads_count, self.concurrency_min, self.workers_count,
+                                     self.concurrency_tolerance, self.concurrency_error_rate)
+
+    def _create_limiter(self, rate):
+        """ Метод создаёт общий для воркеров ограничитель скорости, если ограничение задано """
+        return RateLimiter(rate, rate * self.rate_burst) if rate else None
+
+    def _throttle(self, part):
+        """ Метод забирает маркеры у ограничителей скорости и возвращает время ожидания перед загрузкой.
+         При реальной загрузке байты ограничиваются поблочно в stream_file, при имитации - размером части файла """
+        delay = 0.0
+        if self._uploads_limiter is not None:
+            delay = self._uploads_limiter.reserve()
+        if self._bytes_limiter is not None and self.sink is None and part is not None:
+            delay = max(delay, self._bytes_limiter.reserve(part[1]))
+        return delay
+
+    def _emulated_time(self, part):
+        """ Время имитации загрузки файла или его части """
+        if self.emulated_speed is None or part is None:
+            return self.worker_time
+        return part[1] / self.emulated_speed
 
-    def _done(self, report):
-        """ Callback-функция для получения результатов """
-        self._result.append(report)  # Сохраняем результат в общий список
+    @staticmethod
+    def _byte_range(part):
+        """ Смещение и длина загружаемой части файла для stream_file """
+        return (part[0], part[1]) if is_part(part) else (0, None)
+
+    def _emulate_error(self):
+        """ Имитация ошибки во время загрузки """
+        if self.error_emulation:
+            if random() < self.error_rate:
+                raise ValueError('Emulated error')
+
+    def _report_done(self, report):
+        """ Метод завершает отчёт об успешной загрузке """
+        # "Загрузка" окончена
+        report.status = 'done'
+        report.finished_at = monotonic()
+
+        # Изменяем счётчик в ячейке воркера и получаем общие значения: файлы, загружаемые частями, учитывает
+        # основной процесс после загрузки всех частей
+        if not is_part(report.part):
+            self._counters.add(processed=1)
+        report.processed_count, report.errors_count = self._counters.totals()
+
+    def _report_error(self, report, error):
+        """ Метод завершает отчёт об ошибке загрузки """
+        # Сохраняем информацию о возможной ошибке
+        report.status = 'error'
+        report.error_message = error
+        report.finished_at = monotonic()
+
+        # Изменяем счётчики в ячейке воркера и получаем общие значения: файл, который ещё будет загружаться
+        # повторно, обработанным не считается
+        if report.attempt >= self.retry_attempts and not is_part(report.part):
+            self._counters.add(processed=1, errors=1)
+        report.processed_count, report.errors_count = self._counters.totals()
+
+    def _done(self, index, report):
+        """ Callback-функция для получения результатов: принимает позицию файла в списке и отчёт """
+        attempt, report = report, self._dispatcher.done(index, report)
+        if self._journal is not None:
+            self._record(attempt, report)
+        self._count_skipped_rows()
+        if report is not None:  # Иначе файл поставлен на повторную попытку или ещё загружаются другие его части
+            self._complete(index, report)
+        self._publish_metrics()
+        self._dispatcher.settled()  # Последний отчёт заканчивает загрузку
+
+    def _complete(self, index, report):
+        """ Метод учитывает итоговый отчёт о файле и отправляет его в очередь """
+        # Итоговый отчёт о файле, загруженном частями, или о пропущенном файле составил основной процесс
+        if is_part(report.part) or report.status == 'skipped':
+            self._counters.add(processed=1, errors=int(report.status == 'error'))
+            report.processed_count, report.errors_count = self._counters.totals()
+
+        self._result.finish(index, report)  # Сохраняем результат в общий список
 
         # Обновляем счётчики
         self.processed_count += 1
         if report.status == 'done':
             self.uploaded_count += 1
+        elif report.status == 'skipped':
+            self.skipped_count += 1
         else:
             self.errors_count += 1
+        self.bytes_uploaded += report.bytes_sent
 
-        if len(self._result) == self.total_count:  # Проверяем: не закончилась ли работа пула
-            self._calc_result()  # Вызываем подсчёт результатов
-            self.busy = False
+        report.skipped_count = self.skipped_count
+        self._progress.put(report)  # Добавляем отчёт в очередь
 
-    def _generate_aborted_reports(self):
-        """ Метод генерирует репорты для отменённых файлов """
+    def _abort(self):
+        """ Метод отмечает незавершённые файлы отменёнными и заканчивает остановленную загрузку """
+        self._count_skipped_rows()
+        self._generate_aborted_reports()  # Создаём отчёты для отменённых файлов
 
-        # Вычисляем файлы, которые не были загружены из-за принудительной остановки и создаём отчёты для них
-        processed_files = [report.filename for report in self._result]
-        aborted_files = list(set(self.files_to_upload) - set(processed_files))
-        self.aborted_count = len(aborted_files)
+        # Устанавливаем флаги состояния
+        self.terminated = True
+        self._finish()
+
+    def _finish(self):
+        """ Метод отмечает окончание загрузки, отправляет оставшиеся отчёты и показатели, фиксирует журнал
+         и кеш и освобождает общую память счётчиков. Выполняется один раз: остановка может совпасть с окончанием
+         загрузки в потоке, который принимает результаты воркеров """
+        with self._finish_lock:
+            if self._finished_at is not None:
+                return
+            self._finish_once()
+
+    def _finish_once(self):
+        """ Окончание загрузки: вызывается под блокировкой """
+        self._count_skipped_rows()
+        if not self.terminated:
+            self.total_count = self._result.added  # Все файлы прочитаны
+        if self._unchanged_count:
+            self._generate_skipped_report()  # Очередь раздачи находит такие файлы по мере чтения входных данных
+        self._progress.close()
+        if self._journal is not None:
+            self._journal.close()
+        if self._cache is not None:
+            self._cache.close()
+        if self.sink is not None:
+            self.sink.close()  # Иначе сервер приёмника ждёт закрытия соединений потоков
+        self.busy = False
+        self._finished_at = monotonic()
+        self._counters.release()
+        self._publish_metrics(force=True)
+
+    def _count_skipped_rows(self):
+        """ Метод учитывает файлы, которые очередь раздачи пропустила с прошлого вызова: загруженные по журналу
+         прошлых запусков - как загруженные, не изменившиеся по кешу - как пропущенные (о них по окончании
+         загрузки отправляется один общий отчёт) """
+        resumed = self._dispatcher.resumed - self.resumed_count
+        unchanged = self._dispatcher.unchanged - self._unchanged_count
+        if resumed or unchanged:
+            self.resumed_count += resumed
+            self.uploaded_count += resumed
+            self._unchanged_count += unchanged
+            self.skipped_count += unchanged
+            self.processed_count += resumed + unchanged
+            self._counters.add(processed=resumed + unchanged)
+
+    def _record(self, attempt, report):
+        """ Метод записывает в журнал загруженный файл или загруженную часть файла: принимает отчёт о попытке
+         и итоговый отчёт о файле (None, если файл ещё не завершён) """
+        if report is not None:
+            if report.status in ('done', 'skipped'):
+                self._journal.record(report.filename)
+        elif attempt.status == 'done' and is_part(attempt.part):
+            self._journal.record(attempt.filename, attempt.part[0])
+
+    def _publish_metrics(self, force=False):
+        """ Метод передаёт показатели в metrics_hook не чаще чем раз в metrics_interval: исключение в нём
+         сохраняется в metrics_hook_error и не прерывает загрузку """
+        if self.metrics_hook is None:
+            return
+        now = monotonic()
+        if force or now - self._metrics_published_at >= self.metrics_interval:
+            self._metrics_published_at = now
+            try:
+                self.metrics_hook(self.metrics())
+            except Exception as error:
+                self.metrics_hook_error = error
+
+    def _generate_skipped_report(self):
+        """ Метод отправляет один общий отчёт о файлах, которые очередь раздачи пропустила по кешу без чтения """
+        report = Report()
+        report.status = 'skipped'
+        report.total_count = self.total_count
+        report.processed_count = self.processed_count
+        report.errors_count = self.errors_count
+        report.aborted_count = self.aborted_count
+        report.skipped_count = self.skipped_count
 
-        for file in aborted_files:
-            report = Report()
-            report.filename = file
-            report.status = 'aborted'
-            report.total_count = self.total_count
-            report.processed_count = self.processed_count
-            report.errors_count = self.errors_count
-            report.aborted_count = self.aborted_count
+        self._progress.put(report)
 
-            self.reports_q.put(report)
-            self._result.append(report)
+    def _generate_aborted_reports(self):
+        """ Метод отмечает все незавершённые файлы отменёнными и отправляет по ним один общий отчёт """
+        self.aborted_count = self._result.abort_remaining()
+        if not self.aborted_count:
+            return
+
+        report = Report()
+        report.status = 'aborted'
+        report.total_count = self.total_count
+        report.processed_count = self.processed_count
+        report.errors_count = self.errors_count
+        report.aborted_count = self.aborted_count
+        report.skipped_count = self.skipped_count
+
+        self._progress.put(report)
+
+    def __getstate__(self):
+        """ Воркерам передаются только настройки загрузки: списки файлов, результаты и пул им не нужны,
+         а настройки отчётов и показателей, которые использует только основной процесс, не передаются вовсе """
+        state = self.__dict__.copy()
+        state.update(files_to_upload=None, reports_q=None, _result=None, _pool=None, _counters=None, _progress=None,
+                     _dispatcher=None, _controller=None, _metrics=None, _journal=None, _cache=None)
+        for name in self._MAIN_PROCESS_SETTINGS + self._MAIN_PROCESS_STATE:
+            state.pop(name, None)
+        return state
 
     @staticmethod
-    def _initializer(total_count, processed_count, errors_count, start_trigger):
-        """ Функция-инициализатор для пула: расшаривает общие переменные между процессами """
-        global TOTAL_COUNT
-        global PROCESSED_COUNT
-        global ERRORS_COUNT
-        global START_TRIGGER
-
-        TOTAL_COUNT = total_count
-        PROCESSED_COUNT = processed_count
-        ERRORS_COUNT = errors_count
-        START_TRIGGER = start_trigger
+    def _initializer(uploader, total_count, counters):
+        """ Функция-инициализатор для пула процессов: передаёт воркеру настройки аплоадера и расшаривает общие
+         счётчики между процессами """
+        global UPLOADER
+
+        UPLOADER = uploader
+        uploader.total_count = total_count
+        uploader._counters = counters
+
+
+def _upload_files(tasks):
+    """ Функция-задача для воркеров пула процессов: сама задача содержит только пачку кортежей
+     (позиция в списке, имя файла, вид задачи, номер попытки, часть файла) """
+    return [(index, UPLOADER._execute(kind, file, attempt, part)) for index, file, kind, attempt, part in tasks]
+
+
+class _ProcessPool:
+    """ Пул процессов для бэкенда 'process': задачи передаются воркерам пачками по chunksize """
+
+    def __init__(self, uploader, initargs):
+        self._uploader = uploader
+        self._terminated = False
+        self._error = None  # Исключение при обработке результатов: выбрасывается из join()
+        self._capacity = uploader.workers_count * (uploader.prefetch + 1)  # Сколько пачек может быть у пула
+        self._slots = threading.Semaphore(self._capacity)
+        self._completed = 0  # Обработанные пачки, места которых ещё не освобождены
+
+        self._pool = Pool(uploader.workers_count, initializer=uploader._initializer, initargs=initargs)
+        batches = self._batches(uploader._dispatcher.batches(uploader.chunksize))
+        results = self._pool.imap_unordered(_upload_files, batches)
+        self._pool.close()
+
+        self._collector = threading.Thread(target=self._collect, args=(results,), daemon=True)
+        self._collector.start()
+
+    def terminate(self):
+        """ Метод немедленно останавливает воркеры """
+        self._terminated = True
+        self._slots.release(self._capacity)  # Пул дожидается потока, который передаёт ему задачи
+        self._pool.terminate()
+
+    def join(self):
+        """ Метод дожидается завершения воркеров и обработки всех полученных результатов """
+        self._pool.join()
+        self._collector.join()
+        if self._error is not None:
+            raise self._error
+
+    def _collect(self, results):
+        """ Функция потока: ошибка при обработке результатов останавливает пул, а не только этот поток """
+        try:
+            self._receive(results)
+        except Exception as error:
+            self._error = error
+            self._uploader._dispatcher.stop()
+            self.terminate()
+
+    def _receive(self, results):
+        """ Метод передаёт результаты воркеров в callback-функцию аплоадера """
+        while not self._terminated:
+            try:
+                reports = results.next(timeout=0.1)
+            except TimeoutError:  # После terminate() итератор никогда не завершится, поэтому ждём с таймаутом
+                continue
+            except StopIteration:
+                return
+
+            self._completed += 1
+            if self._completed * 2 >= self._capacity:
+                self._slots.release(self._completed)
+                self._completed = 0
+
+            for index, report in reports:
+                self._uploader._done(index, report)
+
+    def _batches(self, batches):
+        """ Генератор пачек задач для пула: следующая пачка берётся из очереди раздачи, только когда у пула
+         освободилось место """
+        while True:
+            self._slots.acquire()
+            batch = next(batches, None)
+            if batch is None:
+                return
+            yield batch
+
+
+class _ThreadPool:
+    """ Пул потоков для бэкенда 'thread': подходит для загрузок, во время которых GIL освобождается """
+
+    def __init__(self, uploader):
+        self._uploader = uploader
+        self._error = None  # Исключение при обработке результатов: выбрасывается из join()
+        self._lock = threading.Lock()  # Callback-функции вызываются из разных потоков
+        self._slots = threading.Semaphore(uploader.workers_count * (uploader.prefetch + 1))
+
+        self._executor = ThreadPoolExecutor(uploader.workers_count, thread_name_prefix='Uploader')
+
+        # Задачи из очереди раздачи передаются пулу в отдельном потоке: он ждёт повторных попыток
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def terminate(self):
+        """ Метод отменяет ожидающие загрузки: потоки нельзя прервать, поэтому уже начатые загрузки дорабатывают
+         и учитываются как обычно """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def join(self):
+        """ Метод дожидается завершения раздачи задач и всех потоков """
+        self._dispatcher.join()
+        self._executor.shutdown(wait=True)
+        if self._error is not None:
+            raise self._error
+
+    def _dispatch(self):
+        """ Функция потока: передаёт задачи из очереди раздачи пулу, когда у него освобождается место """
+        tasks = iter(self._uploader._dispatcher)
+        while True:
+            self._slots.acquire()
+            task = next(tasks, None)
+            if task is None:
+                return
+
+            index, file, kind, attempt, part = task
+            try:
+                future = self._executor.submit(self._uploader._execute, kind, file, attempt, part)
+            except RuntimeError:  # Пул уже остановлен методом terminate()
+                return
+            future.add_done_callback(partial(self._done, index))
+
+    def _done(self, index, future):
+        """ Callback-функция для завершённых задач """
+        self._slots.release()
+        if future.cancelled():
+            return
+        with self._lock:
+            try:
+                self._uploader._done(index, future.result())
+            except Exception as error:  # Останавливаем пул, иначе ошибка потеряется в пуле потоков
+                self._error = self._error or error
+                self._uploader._dispatcher.stop()
+                self.terminate()
+
+
+class _AsyncioPool:
+    """ Пул корутин для бэкенда 'asyncio': загрузки выполняются в потоке с циклом событий под семафором """
+
+    def __init__(self, uploader):
+        self._uploader = uploader
+        self._loop = asyncio.new_event_loop()
+        # Потоки создаются по мере надобности, поэтому при имитации загрузки они не создаются вовсе
+        self._loop.set_default_executor(ThreadPoolExecutor(uploader.workers_count,
+                                                           thread_name_prefix='UploaderAsyncio'))
+        self._task = None
+        self._error = None  # Исключение при обработке результатов: выбрасывается из join()
+        self._ready = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait()  # Ожидаем запуск цикла событий
+
+    def terminate(self):
+        """ Метод отменяет все выполняющиеся и ожидающие загрузки (после окончания загрузки ничего не делает) """
+        if self._loop.is_closed() or not self._thread.is_alive():
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        except RuntimeError:  # Цикл событий закрылся уже после проверки
+            pass
+
+    def join(self):
+        """ Метод дожидается завершения цикла событий """
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        """ Функция потока: выполняет цикл событий до окончания загрузки или отмены """
+        asyncio.set_event_loop(self._loop)
+        self._task = self._loop.create_task(self._dispatch())
+        self._loop.call_soon(self._ready.set)
+        try:
+            self._loop.run_until_complete(self._task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.close()
+
+    async def _dispatch(self):
+        """ Корутина запускает загрузки из очереди раздачи по мере освобождения семафора """
+        uploader = self._uploader
+        dispatcher = uploader._dispatcher
+        semaphore = asyncio.Semaphore(uploader.workers_count)
+        wakeup = asyncio.Event()  # Появилась новая повторная попытка или завершилась загрузка
+        tasks = {}  # Выполняющаяся загрузка -> позиция файла в списке
+
+        def done(task):
+            index = tasks.pop(task)
+            semaphore.release()
+            if not task.cancelled():
+                try:
+                    uploader._done(index, task.result())
+                except Exception as error:  # Останавливаем загрузку, иначе ошибка потеряется в цикле событий
+                    self._error = self._error or error
+                    dispatcher.stop()
+                    self._task.cancel()
+            wakeup.set()
+
+        try:
+            while True:
+                await semaphore.acquire()
+                task, wait = dispatcher.poll()
+                if task is None:
+                    semaphore.release()
+                    if wait == 0:  # Загружать больше нечего
+                        break
+
+                    # Ждём готовности повторной попытки или завершения выполняющихся загрузок
+                    wakeup.clear()
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                index, file, kind, attempt, part = task
+                task = asyncio.ensure_future(uploader._execute_async(kind, file, attempt, part))
+                tasks[task] = index
+                task.add_done_callback(done)
+        finally:
+            # При отмене прерываем загрузки, которые ещё выполняются
+            for task in list(tasks):
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,103 @@
+import queue
+import threading
+from time import monotonic
+
+_CLOSE = object()  # Сигнал потоку отправки, что отчётов больше не будет
+
+
+class ProgressChannel:
+    """ Канал для отчётов о прогрессе поверх любой очереди (queue.Queue, multiprocessing.Queue, очередь Manager)
+     или конца канала multiprocessing.Pipe. Режимы:
+     'each' - каждый отчёт отправляется отдельно;
+     'batch' - отчёты накапливаются и отправляются списком при достижении batch_size или по истечении interval;
+     'latest' - раз в interval отправляется только последний отчёт (снимок для дашбордов).
+     Отправляет отчёты отдельный поток, поэтому медленный получатель (например, непрочитанный конец Pipe)
+     не задерживает того, кто их передаёт; close() дожидается отправки всех отчётов """
+
+    MODES = ('each', 'batch', 'latest')  # Доступные режимы
+
+    def __init__(self, target, mode='each', batch_size=100, interval=0.5):
+        if mode not in self.MODES:
+            raise ValueError(f'Unknown progress mode: {mode!r}. Available: {", ".join(self.MODES)}')
+
+        self.mode = mode  # Режим отправки отчётов
+        self.batch_size = batch_size  # Максимальный размер пачки отчётов
+        self.interval = interval  # Максимальная задержка отправки накопленных отчётов, с
+
+        # У очередей метод put, у концов канала - send
+        self._send = target.put if hasattr(target, 'put') else target.send
+        self._pending = []  # Накопленные отчёты (режим 'batch')
+        self._latest = None  # Последний неотправленный отчёт (режим 'latest')
+        self._flushed_at = monotonic()
+        self._lock = threading.Lock()
+
+        self._outbox = queue.SimpleQueue()  # Отчёты и пачки, которые ждут отправки
+        self._sender = threading.Thread(target=self._send_all, daemon=True)
+        self._sender.start()
+
+        self._closed = threading.Event()
+        self._flusher = None
+        if mode != 'each':
+            # Поток отправляет накопленное, даже если новых отчётов долго нет
+            self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._flusher.start()
+
+    def put(self, report):
+        """ Метод принимает очередной отчёт """
+        if self.mode == 'each':
+            self._outbox.put(report)
+            return
+
+        with self._lock:
+            if self.mode == 'batch':
+                self._pending.append(report)
+                if len(self._pending) >= self.batch_size:
+                    self._flush()
+                    return
+            else:
+                self._latest = report
+
+            if monotonic() - self._flushed_at >= self.interval:
+                self._flush()
+
+    def flush(self):
+        """ Метод немедленно отправляет всё накопленное """
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """ Метод отправляет накопленное, дожидается отправки всех отчётов и останавливает фоновую отправку
+         (повторный вызов ничего не делает) """
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        self._outbox.put(_CLOSE)
+        self._sender.join()
+
+    def _flush(self):
+        """ Передача накопленного потоку отправки: вызывается под блокировкой """
+        if self._pending:
+            batch, self._pending = self._pending, []
+            self._outbox.put(batch)
+        if self._latest is not None:
+            report, self._latest = self._latest, None
+            self._outbox.put(report)
+        self._flushed_at = monotonic()
+
+    def _flush_periodically(self):
+        """ Функция потока: отправляет накопленное раз в interval """
+        while not self._closed.wait(self.interval):
+            with self._lock:
+                if monotonic() - self._flushed_at >= self.interval:
+                    self._flush()
+
+    def _send_all(self):
+        """ Функция потока: отправляет отчёты получателю по порядку до закрытия канала """
+        while True:
+            item = self._outbox.get()
+            if item is _CLOSE:
+                return
+            self._send(item)
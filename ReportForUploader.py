@@ -1,17 +1,61 @@
 class Report:
     """ Класс для создания отчётов """
 
+    # Возможные статусы: код статуса - индекс в кортеже
+    STATUSES = ('pending', 'uploading', 'done', 'error', 'aborted', 'skipped')
+    STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+
+    __slots__ = ('total_count', 'filename', 'status_code', 'processed_count', 'errors_count', 'aborted_count',
+                 'skipped_count', 'error_message', 'bytes_sent', 'kind', 'attempt', 'part', 'enqueued_at', 'started_at',
+                 'finished_at', 'worker_pid', 'worker_thread', 'content')
+
     def __init__(self):
         self.total_count = None
         self.filename = None
-        self.status = None
+        self.status_code = None  # Статус хранится кодом, а строка берётся из общего кортежа STATUSES
         self.processed_count = None
         self.errors_count = None
         self.aborted_count = None
+        self.skipped_count = None  # Количество пропущенных файлов (заполняет основной процесс)
         self.error_message = None
+        self.bytes_sent = 0
+        self.kind = 'upload'  # Вид задачи: 'upload' - загрузка, 'hash' - вычисление хеша содержимого
+        self.attempt = 1  # Номер попытки загрузки файла
+        self.part = None  # Загружаемая часть файла: (смещение, длина, размер файла) или None
+        self.enqueued_at = None  # Время передачи задачи воркерам (time.monotonic, общее для процессов)
+        self.started_at = None  # Время начала загрузки
+        self.finished_at = None  # Время окончания загрузки
+        self.worker_pid = None  # PID процесса воркера
+        self.worker_thread = None  # Идентификатор потока воркера (threading.get_ident) внутри процесса
+        self.content = None  # Хеш содержимого файла, если он вычислялся: (хеш, размер, mtime_ns)
+
+    @property
+    def status(self):
+        """ Статус отчёта строкой """
+        return None if self.status_code is None else self.STATUSES[self.status_code]
+
+    @status.setter
+    def status(self, value):
+        try:
+            self.status_code = self.STATUS_CODES[value]
+        except KeyError:
+            raise ValueError(f'Unknown report status: {value!r}') from None
 
     @property
     def progress(self):
         """ Метод показывает текущий прогресс """
-        return f'Processed {self.processed_count} of {self.total_count} files with {self.errors_count} errors ' \
+        total_count = '?' if self.total_count is None else self.total_count  # Файлы приходят потоком
+        return f'Processed {self.processed_count} of {total_count} files with {self.errors_count} errors ' \
                f'and {self.aborted_count} aborted.'
+
+    def __reduce__(self):
+        # Отчёты передаются между процессами компактным кортежем значений
+        return _restore_report, tuple(getattr(self, name) for name in self.__slots__)
+
+
+def _restore_report(*values):
+    """ Функция восстанавливает отчёт из кортежа значений """
+    report = Report.__new__(Report)
+    for name, value in zip(Report.__slots__, values):
+        setattr(report, name, value)
+    return report
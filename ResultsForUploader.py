@@ -0,0 +1,121 @@
+from collections.abc import Sequence
+
+from ReportForUploader import Report
+
+PENDING = Report.STATUS_CODES['pending']
+UPLOADING = Report.STATUS_CODES['uploading']
+DONE = Report.STATUS_CODES['done']
+ABORTED = Report.STATUS_CODES['aborted']
+SKIPPED = Report.STATUS_CODES['skipped']
+
+# Таблица для bytes.translate: ожидающие и выполняющиеся файлы становятся отменёнными
+_ABORT_TABLE = bytes(ABORTED if code in (PENDING, UPLOADING) else code for code in range(256))
+
+
+class ResultStore:
+    """ Колоночное хранилище состояний файлов по их позиции в списке загрузки: имена файлов берутся из самого
+     списка, статусы хранятся байтами, а сообщения об ошибках - в отдельной таблице только для строк с ошибками.
+     Одинаковые имена файлов в списке учитываются по отдельности. Если файлы приходят потоком (генератор, обход
+     каталога), строки добавляются по мере чтения, а при keep_done=False имена загруженных и пропущенных файлов
+     не хранятся, чтобы память почти не росла с количеством файлов """
+
+    def __init__(self, files=(), keep_done=True):
+        streaming = not isinstance(files, Sequence)
+        self._filenames = [] if streaming else files  # Исходный список файлов (не копируется)
+        self._statuses = bytearray(0 if streaming else len(files))  # Коды статусов (Report.STATUS_CODES),
+        # изначально 'pending'
+        self._drop_done = streaming and not keep_done  # Не хранить имена загруженных файлов
+        self._added = 0  # Количество прочитанных из входных данных файлов
+        self._errors = {}  # Номер строки -> сообщение об ошибке
+        self._finished = 0  # Количество файлов с итоговым статусом
+        self._cache = {}  # Код статуса -> (количество завершённых, список файлов) для повторных обращений
+
+    def __len__(self):
+        """ Количество файлов с итоговым статусом """
+        return self._finished
+
+    def __iter__(self):
+        """ Итоговые отчёты восстанавливаются по мере обхода """
+        for row, (filename, status_code) in enumerate(zip(self._filenames, self._statuses)):
+            if status_code > UPLOADING:
+                report = Report()
+                report.filename = filename
+                report.status_code = status_code
+                report.error_message = self._errors.get(row)
+                yield report
+
+    @property
+    def added(self):
+        """ Количество прочитанных из входных данных файлов """
+        return self._added
+
+    def add(self, filename):
+        """ Метод отмечает, что очередной файл прочитан из входных данных, и возвращает номер его строки """
+        row = self._added
+        self._added += 1
+        if row == len(self._statuses):  # Файлы приходят потоком
+            self._filenames.append(filename)
+            self._statuses.append(PENDING)
+        return row
+
+    def complete(self, row, status_code=DONE):
+        """ Метод отмечает файл загруженным (или пропущенным) без отчёта, например загруженным при прошлом
+         запуске """
+        if self._statuses[row] <= UPLOADING:
+            self._finished += 1
+        self._statuses[row] = status_code
+        if self._drop_done:
+            self._filenames[row] = None
+
+    def dispatch(self, row):
+        """ Метод отмечает, что файл передан на загрузку """
+        self._statuses[row] = UPLOADING
+
+    def requeue(self, row):
+        """ Метод отмечает, что файл ждёт повторной попытки загрузки """
+        self._statuses[row] = PENDING
+
+    def finish(self, row, report):
+        """ Метод сохраняет итоговый отчёт о файле """
+        if self._statuses[row] <= UPLOADING:
+            self._finished += 1
+        if report.error_message is not None:
+            self._errors[row] = report.error_message
+        self._statuses[row] = report.status_code
+        if self._drop_done and report.status_code in (DONE, SKIPPED):
+            self._filenames[row] = None
+
+    def abort_remaining(self):
+        """ Метод отмечает все незавершённые файлы отменёнными и возвращает их количество """
+        aborted = len(self._statuses) - self._finished
+        if aborted:
+            self._statuses[:] = self._statuses.translate(_ABORT_TABLE)
+            self._finished = len(self._statuses)
+        return aborted
+
+    def rows(self, status):
+        """ Генератор возвращает (имя файла, сообщение об ошибке) для файлов с заданным статусом (без файлов,
+         имена которых не хранятся) """
+        code = Report.STATUS_CODES[status]
+        for row, (filename, status_code) in enumerate(zip(self._filenames, self._statuses)):
+            if status_code == code and filename is not None:
+                yield filename, self._errors.get(row)
+
+    def count(self, status):
+        """ Метод возвращает количество файлов с заданным статусом """
+        return self._statuses.count(Report.STATUS_CODES[status])
+
+    def filenames(self, status=None):
+        """ Метод возвращает файлы с заданным итоговым статусом (или все завершённые файлы); список строится
+         при первом обращении и пересобирается только после появления новых отчётов """
+        if status is None:
+            return [filename for filename, status_code in zip(self._filenames, self._statuses)
+                    if status_code > UPLOADING and filename is not None]
+
+        code = Report.STATUS_CODES[status]
+        finished, files = self._cache.get(code, (None, None))
+        if finished != self._finished:
+            files = [filename for filename, status_code in zip(self._filenames, self._statuses)
+                     if status_code == code and filename is not None]
+            self._cache[code] = (self._finished, files)
+        return list(files)
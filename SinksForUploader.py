@@ -0,0 +1,180 @@
+import mmap
+import os
+import socket
+import threading
+from hashlib import blake2b
+
+
+class NullSink:
+    """ Приёмник, который просто отбрасывает полученные данные """
+
+    def write(self, chunk):
+        """ Метод принимает очередной блок данных и возвращает количество "отправленных" байт """
+        return len(chunk)
+
+    def close(self):
+        """ Закрывать нечего """
+
+
+class SocketSink:
+    """ Приёмник, который отправляет данные в TCP-сокет (например, в LocalSinkServer): у каждого потока своё
+     соединение, поэтому блоки разных файлов не перемешиваются, а каждый процесс-воркер открывает свои соединения """
+
+    def __init__(self, address):
+        self.address = address  # Адрес сервера: (host, port)
+        self._local = threading.local()  # Соединение текущего потока создаётся лениво
+        self._sockets = []  # Все открытые соединения, чтобы закрыть их в close()
+        self._lock = threading.Lock()
+
+    def write(self, chunk):
+        """ Метод отправляет блок данных на сервер через соединение текущего потока """
+        connection = getattr(self._local, 'socket', None)
+        if connection is None:
+            connection = socket.create_connection(self.address)
+            self._local.socket = connection
+            with self._lock:
+                self._sockets.append(connection)
+        connection.sendall(chunk)
+        return len(chunk)
+
+    def close(self):
+        """ Метод закрывает соединения всех потоков с сервером """
+        with self._lock:
+            sockets, self._sockets = self._sockets, []
+            self._local = threading.local()
+        for connection in sockets:
+            connection.close()
+
+    def __getstate__(self):
+        # Соединения не передаются между процессами: каждый воркер открывает свои
+        return {'address': self.address}
+
+    def __setstate__(self, state):
+        self.__init__(state['address'])
+
+
+class LocalSinkServer:
+    """ Локальный TCP-сервер, который принимает и отбрасывает данные, подсчитывая полученные байты """
+
+    def __init__(self, host='127.0.0.1', buffer_size=256 * 1024):
+        self._server = socket.create_server((host, 0))
+        self.address = self._server.getsockname()[:2]  # Адрес, к которому подключаются приёмники
+        self.buffer_size = buffer_size  # Размер буфера для чтения из соединений
+        self.received = 0  # Количество полученных байт
+
+        self._lock = threading.Lock()
+        self._threads = []
+        self._acceptor = None
+
+    def start(self):
+        """ Метод запускает приём соединений в фоновом потоке """
+        self._acceptor = threading.Thread(target=self._accept, daemon=True)
+        self._acceptor.start()
+        return self
+
+    def stop(self):
+        """ Метод останавливает сервер и дожидается завершения обработки соединений """
+        try:
+            self._server.shutdown(socket.SHUT_RDWR)  # Прерываем ожидающий accept()
+        except OSError:
+            pass
+        self._server.close()
+        self._acceptor.join()
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _accept(self):
+        """ Цикл приёма новых соединений """
+        while True:
+            try:
+                connection, _ = self._server.accept()
+            except OSError:  # Сервер закрыт
+                return
+            thread = threading.Thread(target=self._drain, args=(connection,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _drain(self, connection):
+        """ Метод вычитывает данные из соединения в переиспользуемый буфер """
+        buffer = bytearray(self.buffer_size)
+        with connection:
+            while True:
+                try:
+                    received = connection.recv_into(buffer)
+                except OSError:
+                    return
+                if not received:
+                    return
+                with self._lock:
+                    self.received += received
+
+
+# Буферы для чтения переиспользуются в пределах потока, чтобы не выделять память на каждый файл
+_buffers = threading.local()
+
+
+def _get_buffer(chunk_size):
+    """ Функция возвращает переиспользуемый буфер нужного размера для текущего потока """
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != chunk_size:
+        buffer = bytearray(chunk_size)
+        _buffers.buffer = buffer
+    return buffer
+
+
+def stream_file(path, sink, chunk_size, mmap_threshold, offset=0, length=None, limiter=None):
+    """ Функция читает файл (или его часть с заданного смещения длиной length) блоками без лишнего копирования
+     и передаёт их в приёмник: небольшие файлы читаются через readinto в переиспользуемый буфер, крупные - через
+     mmap. Если задан limiter (RateLimiter), перед отправкой каждого блока ожидаются маркеры на его размер.
+     Возвращает количество отправленных байт """
+    sent = 0
+    with open(path, 'rb', buffering=0) as file:
+        size = os.fstat(file.fileno()).st_size
+        end = size if length is None else min(size, offset + length)
+
+        if size and size >= mmap_threshold:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for position in range(offset, end, chunk_size):
+                        read = min(chunk_size, end - position)
+                        if limiter is not None:
+                            limiter.acquire(read)
+                        sent += sink.write(view[position:position + read])
+                finally:
+                    view.release()  # Без этого mmap нельзя закрыть
+            return sent
+
+        if offset:
+            file.seek(offset)
+        view = memoryview(_get_buffer(chunk_size))
+        while sent < end - offset:
+            read = file.readinto(view[:min(chunk_size, end - offset - sent)])
+            if not read:
+                break
+            if limiter is not None:
+                limiter.acquire(read)
+            sent += sink.write(view[:read])
+    return sent
+
+
+def hash_file(path, chunk_size):
+    """ Функция потоково вычисляет хеш содержимого файла (BLAKE2b, 16 байт), читая его блоками в переиспользуемый
+     буфер. Возвращает (хеш, размер, mtime_ns): размер и время изменения берутся до чтения, поэтому изменение файла
+     во время чтения будет замечено при следующей загрузке """
+    digest = blake2b(digest_size=16)
+    with open(path, 'rb', buffering=0) as file:
+        stat = os.fstat(file.fileno())
+        view = memoryview(_get_buffer(chunk_size))
+        while True:
+            read = file.readinto(view)
+            if not read:
+                break
+            digest.update(view[:read])
+    return digest.digest(), stat.st_size, stat.st_mtime_ns
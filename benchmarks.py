@@ -0,0 +1,432 @@
+import argparse
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import resource
+import sys
+import tempfile
+from multiprocessing import Manager
+from time import monotonic, sleep
+
+from LimiterForUploader import RateLimiter
+from ParallelFilesUploaderEmulation import Uploader
+from SinksForUploader import NullSink
+
+
+def run_uploader(files_list, threads_count, reports_q, backend, worker_time=0.0, timeout=60.0, chunksize=1,
+                 **settings):
+    """ Функция запускает аплоадер и возвращает замеры: время запуска, общее время и количество
+     обработанных файлов. Если загрузка не уложилась в timeout, она принудительно останавливается.
+     Остальные настройки аплоадера передаются через settings """
+    uploader = Uploader(files_list, threads_count, reports_q)
+    uploader.backend = backend
+    uploader.worker_time = worker_time
+    uploader.chunksize = chunksize
+    for name, value in settings.items():
+        setattr(uploader, name, value)
+
+    started_at = monotonic()
+    uploader.start()
+    startup = monotonic() - started_at
+
+    while uploader.is_active() and monotonic() - started_at < timeout:
+        sleep(0.001)
+
+    timed_out = uploader.is_active()
+    if timed_out:
+        uploader.stop()
+    else:
+        uploader.join()
+    elapsed = monotonic() - started_at
+
+    return {
+        'startup': startup,
+        'elapsed': elapsed,
+        'processed': uploader.processed_count,
+        'timed_out': timed_out,
+    }
+
+
+def bench_backends(sizes, backends, threads_count, timeout):
+    """ Сравнение бэкендов: задержка запуска и накладные расходы на один файл при нулевом времени загрузки """
+    manager = Manager()
+    results = []
+
+    for files_count in sizes:
+        files_list = ['file' + str(c) for c in range(files_count)]
+
+        for backend in backends:
+            reports_q = manager.Queue()
+            measure = run_uploader(files_list, threads_count, reports_q, backend, timeout=timeout)
+            measure.update(backend=backend, files=files_count)
+            results.append(measure)
+
+            per_file = measure['elapsed'] / measure['processed'] * 1e6 if measure['processed'] else float('nan')
+            print(f"{backend:>8} {files_count:>8} files: "
+                  f"startup {measure['startup'] * 1e3:9.2f} ms, "
+                  f"per file {per_file:9.1f} us, "
+                  f"processed {measure['processed']}{' (timed out)' if measure['timed_out'] else ''}",
+                  flush=True)
+
+    return results
+
+
+def bench_dispatch(sizes, chunksizes, threads_count, timeout):
+    """ Регрессионный замер раздачи задач пулу процессов: накладные расходы на один файл
+     не должны расти с увеличением размера списка файлов """
+    manager = Manager()
+    results = []
+
+    for chunksize in chunksizes:
+        for files_count in sizes:
+            files_list = ['file' + str(c) for c in range(files_count)]
+            measure = run_uploader(files_list, threads_count, manager.Queue(), 'process', timeout=timeout,
+                                   chunksize=chunksize)
+            measure.update(chunksize=chunksize, files=files_count)
+            results.append(measure)
+
+            per_file = measure['elapsed'] / measure['processed'] * 1e6 if measure['processed'] else float('nan')
+            print(f"chunksize {chunksize:>4} {files_count:>8} files: "
+                  f"per file {per_file:9.1f} us, "
+                  f"processed {measure['processed']}{' (timed out)' if measure['timed_out'] else ''}",
+                  flush=True)
+
+    return results
+
+
+def skewed_sizes(files_count, alpha, seed=0):
+    """ Синтетические размеры файлов с распределением Парето: много мелких файлов и несколько очень крупных """
+    generator = random.Random(seed)
+    return [int(generator.paretovariate(alpha) * 1024) for _ in range(files_count)]
+
+
+def bench_schedule(sizes, threads_count, alphas, speed, part_size, timeout):
+    """ Сравнение порядков раздачи на файлах разного размера: общее время загрузки (makespan) относительно
+     нижней оценки - суммарного объёма, поделённого между воркерами поровну """
+    results = []
+    schedules = (('fifo', None), ('largest_first', None), ('largest_first', part_size))
+
+    for alpha in alphas:
+        for files_count in sizes:
+            files_list = ['file' + str(c) for c in range(files_count)]
+            file_sizes = skewed_sizes(files_count, alpha)
+            bound = sum(file_sizes) / speed / threads_count
+
+            for schedule, split in schedules:
+                measure = run_uploader(files_list, threads_count, queue.Queue(), 'thread', timeout=timeout,
+                                       emulated_speed=speed, file_sizes=file_sizes, schedule=schedule,
+                                       part_size=split)
+                measure.update(alpha=alpha, files=files_count, schedule=schedule, part_size=split, bound=bound)
+                results.append(measure)
+
+                print(f"alpha {alpha:4.2f} {files_count:>6} files {schedule:>13} part {str(split):>8}: "
+                      f"makespan {measure['elapsed']:7.3f} s, "
+                      f"bound {bound:7.3f} s ({measure['elapsed'] / bound:5.2f}x)"
+                      f"{' (timed out)' if measure['timed_out'] else ''}",
+                      flush=True)
+
+    return results
+
+
+def bench_limit(limits, backends, threads_count, timeout, files_count=64, file_size=1024 * 1024):
+    """ Точность общего ограничения скорости передачи: реальные файлы читаются в NullSink, достигнутая скорость
+     сравнивается с заданной. Отдельно замеряются накладные расходы ограничителя на один блок """
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files_list = []
+        for number in range(files_count):
+            path = os.path.join(tmp_dir, f'file{number}')
+            with open(path, 'wb') as file:
+                file.write(os.urandom(file_size))
+            files_list.append(path)
+
+        for limit in limits:
+            for backend in backends:
+                measure = run_uploader(files_list, threads_count, queue.Queue(), backend, timeout=timeout,
+                                       sink=NullSink(), chunk_size=64 * 1024, bytes_per_second=limit * 1024 * 1024,
+                                       rate_burst=0.01)
+                achieved = files_count * file_size / measure['elapsed'] / (1024 * 1024)
+                measure.update(backend=backend, limit=limit, achieved=achieved)
+                results.append(measure)
+
+                print(f"{backend:>8} limit {limit:8.1f} MB/s: achieved {achieved:8.1f} MB/s "
+                      f"({achieved / limit * 100:5.1f}%){' (timed out)' if measure['timed_out'] else ''}",
+                      flush=True)
+
+    # Без ожидания: стоимость пересчёта маркеров под общей блокировкой
+    limiter = RateLimiter(float('inf'))
+    calls = 100000
+    started_at = monotonic()
+    for _ in range(calls):
+        limiter.acquire(64 * 1024)
+    overhead = (monotonic() - started_at) / calls * 1e6
+    print(f"limiter overhead: {overhead:.2f} us per chunk", flush=True)
+
+    return results
+
+
+def bench_cache(sizes, backends, threads_count, timeout, file_size=64 * 1024):
+    """ Повторная загрузка с кешем: первая загрузка реальных файлов в NullSink, повторная без изменений (файлы
+     пропускаются без чтения) и повторная после изменения времени изменения всех файлов (сверка по хешу) """
+    results = []
+
+    for files_count in sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files_list = []
+            for number in range(files_count):
+                path = os.path.join(tmp_dir, f'file{number}')
+                with open(path, 'wb') as file:
+                    file.write(os.urandom(file_size))
+                files_list.append(path)
+
+            for backend in backends:
+                cache = os.path.join(tmp_dir, f'{backend}.db')
+                measures = {}
+                for run in ('upload', 'unchanged', 'touched'):
+                    if run == 'touched':
+                        for path in files_list:
+                            os.utime(path)
+                    measures[run] = run_uploader(files_list, threads_count, queue.Queue(), backend, timeout=timeout,
+                                                 sink=NullSink(), cache=cache)
+                results.append(dict(backend=backend, files=files_count, **measures))
+
+                print(f"{backend:>8} {files_count:>7} files: upload {measures['upload']['elapsed']:8.3f} s, "
+                      f"unchanged {measures['unchanged']['elapsed']:8.3f} s, "
+                      f"touched {measures['touched']['elapsed']:8.3f} s",
+                      flush=True)
+
+    return results
+
+
+DISTRIBUTIONS = ('const', 'uniform', 'exponential', 'pareto')  # Распределения времени загрузки файлов
+SPEED = 1e6  # Скорость имитации загрузки для распределений времени: байт (микросекунд) в секунду
+
+
+def worker_times(distribution, files_count, mean, seed=0):
+    """ Время загрузки каждого файла по заданному распределению со средним mean, с """
+    generator = random.Random(seed)
+    if distribution == 'const' or not mean:
+        return [mean] * files_count
+    if distribution == 'uniform':
+        return [generator.uniform(0, 2 * mean) for _ in range(files_count)]
+    if distribution == 'exponential':
+        return [generator.expovariate(1 / mean) for _ in range(files_count)]
+    # Парето с alpha 1.5: среднее в три раза больше минимального значения
+    return [mean / 3 * generator.paretovariate(1.5) for _ in range(files_count)]
+
+
+def percentile(values, q):
+    """ Перцентиль q (0-100) по методу ближайшего ранга для отсортированного списка """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))]
+
+
+def peak_rss():
+    """ Пиковый размер резидентной памяти процесса и его дочерних процессов (наибольший из них), байт """
+    scale = 1 if sys.platform == 'darwin' else 1024  # На Linux ru_maxrss в килобайтах
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def measure_case(files_count, threads_count, backend, distribution, worker_time, error_rate, timeout):
+    """ Один прогон нагрузочного замера: пропускная способность, задержки загрузки файлов по отчётам
+     и пиковая память. Отдельным прогоном на тех же настройках замеряется время stop() на середине загрузки """
+    files_list = ['file' + str(c) for c in range(files_count)]
+    file_sizes = [int(time * SPEED) for time in worker_times(distribution, files_count, worker_time)]
+
+    def create_uploader(reports_q):
+        uploader = Uploader(files_list, threads_count, reports_q)
+        uploader.backend = backend
+        uploader.file_sizes = file_sizes
+        uploader.emulated_speed = SPEED
+        uploader.error_emulation = bool(error_rate)
+        uploader.error_rate = error_rate
+        return uploader
+
+    # Отчёты вычитываются во время загрузки, чтобы очередь не занимала память
+    reports_q = queue.Queue()
+    uploader = create_uploader(reports_q)
+    latencies = []
+    started_at = monotonic()
+    uploader.start()
+    while True:
+        try:
+            report = reports_q.get(timeout=0.05)
+        except queue.Empty:
+            if not uploader.is_active() or monotonic() - started_at > timeout:
+                break
+            continue
+        if report.started_at is not None:
+            latencies.append(report.finished_at - report.started_at)
+
+    timed_out = uploader.is_active()
+    if timed_out:
+        uploader.stop()
+    else:
+        uploader.join()
+    elapsed = monotonic() - started_at
+    processed = uploader.processed_count
+    latencies.sort()
+
+    # Остановка, когда загружена примерно половина файлов
+    uploader = create_uploader(queue.Queue())
+    uploader.start()
+    while uploader.is_active() and uploader.processed_count < files_count // 2:
+        sleep(0.001)
+    stop_latency = None
+    if uploader.is_active():
+        stopped_at = monotonic()
+        uploader.stop()
+        stop_latency = monotonic() - stopped_at
+    else:
+        uploader.join()
+
+    rss, rss_children = peak_rss()
+    return {
+        'files': files_count,
+        'threads': threads_count,
+        'backend': backend,
+        'distribution': distribution,
+        'worker_time': worker_time,
+        'error_rate': error_rate,
+        'elapsed': elapsed,
+        'processed': processed,
+        'throughput': processed / elapsed if elapsed else None,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'stop_latency': stop_latency,
+        'peak_rss': rss,
+        'peak_rss_children': rss_children,
+        'timed_out': timed_out,
+    }
+
+
+def _measure_case_isolated(connection, *case):
+    """ Функция дочернего процесса: выполняет замер и отправляет результат через канал """
+    connection.send(measure_case(*case))
+    connection.close()
+
+
+def bench_sweep(sizes, threads, backends, distributions, worker_time, error_rates, timeout):
+    """ Нагрузочный замер по всем сочетаниям настроек: каждый прогон выполняется в отдельном процессе,
+     чтобы пиковая память не накапливалась между прогонами. Результаты возвращаются списком словарей,
+     построчно печатаются в stderr """
+    context = multiprocessing.get_context('spawn')
+    results = []
+
+    for case in itertools.product(sizes, threads, backends, distributions, [worker_time], error_rates):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_measure_case_isolated, args=(sender, *case, timeout))
+        process.start()
+        sender.close()
+        measure = receiver.recv()
+        process.join()
+        results.append(measure)
+
+        print(f"{measure['backend']:>8} {measure['files']:>8} files {measure['threads']:>4} threads "
+              f"{measure['distribution']:>11} errors {measure['error_rate']:4.2f}: "
+              f"{measure['throughput']:10.1f} files/s, "
+              f"p50 {_format_ms(measure['latency_p50'])}, p99 {_format_ms(measure['latency_p99'])}, "
+              f"stop {_format_ms(measure['stop_latency'])}, "
+              f"rss {measure['peak_rss'] / 1024 / 1024:7.1f} MB"
+              f"{' (timed out)' if measure['timed_out'] else ''}",
+              file=sys.stderr, flush=True)
+
+    return results
+
+
+def _format_ms(value):
+    """ Время в миллисекундах для вывода, '-' если замера нет """
+    return f'{value * 1e3:8.2f} ms' if value is not None else f'{"-":>8}   '
+
+
+def _case_key(measure):
+    """ Ключ для сопоставления прогонов разных версий """
+    return tuple(measure[name] for name in ('files', 'threads', 'backend', 'distribution', 'worker_time',
+                                            'error_rate'))
+
+
+def compare(results, baseline, tolerance):
+    """ Сравнение с сохранённым результатом: возвращает прогоны, в которых пропускная способность упала
+     больше чем на долю tolerance, в виде (ключ прогона, было, стало) """
+    previous = {_case_key(measure): measure for measure in baseline['results']}
+    regressions = []
+    for measure in results:
+        before = previous.get(_case_key(measure))
+        if before is None or not before['throughput'] or measure['throughput'] is None:
+            continue
+        if measure['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append((_case_key(measure), before['throughput'], measure['throughput']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Uploader benchmarks')
+    parser.add_argument('bench', nargs='?', default='backends',
+                        choices=('backends', 'dispatch', 'schedule', 'limit', 'cache', 'sweep'),
+                        help='Сравнение бэкендов, регрессионный замер раздачи задач пулу процессов, '
+                             'сравнение порядков раздачи файлов разного размера, точность ограничения скорости, '
+                             'повторная загрузка с кешем или нагрузочный замер по сочетаниям настроек '
+                             'с результатом в JSON')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 100000], help='Количество файлов')
+    parser.add_argument('--backends', nargs='+', default=list(Uploader.BACKENDS), choices=Uploader.BACKENDS)
+    parser.add_argument('--chunksizes', type=int, nargs='+', default=[1, 64],
+                        help='Количество файлов в одной задаче для пула процессов')
+    parser.add_argument('--threads', type=int, nargs='+', default=[4],
+                        help='Количество параллельных потоков (для sweep - несколько значений)')
+    parser.add_argument('--timeout', type=float, default=60.0, help='Ограничение времени на один прогон, с')
+    parser.add_argument('--alphas', type=float, nargs='+', default=[1.1, 2.0],
+                        help='Параметры распределения Парето размеров файлов (меньше - сильнее перекос)')
+    parser.add_argument('--speed', type=float, default=1024 * 1024, help='Скорость имитации загрузки, байт/с')
+    parser.add_argument('--part-size', type=int, default=256 * 1024, help='Размер части крупного файла, байт')
+    parser.add_argument('--limits', type=float, nargs='+', default=[16.0, 64.0, 256.0],
+                        help='Ограничения скорости передачи, МБ/с')
+    parser.add_argument('--distributions', nargs='+', default=['const'], choices=DISTRIBUTIONS,
+                        help='Распределения времени загрузки файлов')
+    parser.add_argument('--worker-time', type=float, default=0.001, help='Среднее время загрузки файла, с')
+    parser.add_argument('--error-rates', type=float, nargs='+', default=[0.0],
+                        help='Вероятности имитируемой ошибки загрузки')
+    parser.add_argument('--output', help='Файл для результата sweep в JSON (по умолчанию - stdout)')
+    parser.add_argument('--baseline', help='Результат sweep предыдущей версии для сравнения')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Допустимое падение пропускной способности относительно baseline')
+    args = parser.parse_args()
+    threads = args.threads[0]
+
+    if args.bench == 'backends':
+        bench_backends(args.sizes, args.backends, threads, args.timeout)
+    elif args.bench == 'dispatch':
+        bench_dispatch(args.sizes, args.chunksizes, threads, args.timeout)
+    elif args.bench == 'schedule':
+        bench_schedule(args.sizes, threads, args.alphas, args.speed, args.part_size, args.timeout)
+    elif args.bench == 'limit':
+        bench_limit(args.limits, args.backends, threads, args.timeout)
+    elif args.bench == 'cache':
+        bench_cache(args.sizes, args.backends, threads, args.timeout)
+    else:
+        sweep = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'results': bench_sweep(args.sizes, args.threads, args.backends, args.distributions, args.worker_time,
+                                   args.error_rates, args.timeout),
+        }
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(sweep, file, indent=2)
+        else:
+            print(json.dumps(sweep, indent=2))
+
+        if args.baseline:
+            with open(args.baseline) as file:
+                regressions = compare(sweep['results'], json.load(file), args.tolerance)
+            for key, before, after in regressions:
+                print(f'REGRESSION {key}: {before:.1f} -> {after:.1f} files/s', file=sys.stderr)
+            sys.exit(1 if regressions else 0)
@@ -1,13 +1,35 @@
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import queue
+import tempfile
+import threading
+import time
 import unittest
-from multiprocessing import Manager
+from multiprocessing import Manager, Pipe, Pool
+from unittest import mock
 
+from CacheForUploader import Deduplicator, UploadCache
+from ConcurrencyForUploader import ConcurrencyController
+from CountersForUploader import ProgressCounters
+from DispatchForUploader import HASH, UPLOAD, Dispatcher, stat_sizes, walk_files
+from JournalForUploader import Journal
+from LimiterForUploader import RateLimiter
+from MetricsForUploader import Histogram
 from ParallelFilesUploaderEmulation import Uploader
+from ProgressForUploader import ProgressChannel
 from ReportForUploader import Report
+from ResultsForUploader import ResultStore
+from SinksForUploader import LocalSinkServer, NullSink, SocketSink
 
 
 class TestFilesUploader(unittest.TestCase):
     """ Test using normal stop """
 
+    backend = 'process'
+
     def setUp(self):
         files_list = ['file' + str(c) for c in range(20)]
 
@@ -15,6 +37,7 @@ class TestFilesUploader(unittest.TestCase):
         q = manager.Queue()
 
         uploader = Uploader(files_list, 4, q)
+        uploader.backend = self.backend
         uploader.error_emulation = True
         uploader.worker_time = 0.1
 
@@ -24,6 +47,14 @@ class TestFilesUploader(unittest.TestCase):
         self.files_list = files_list
         self.uploader = uploader
 
+    def testStopAfterFinish(self):
+        aborted_count = self.uploader.aborted_count
+        self.uploader.stop()  # Повторное окончание загрузки не должно освобождать общую память ещё раз
+
+        self.assertTrue(self.uploader.terminated)
+        self.assertFalse(self.uploader.is_active())
+        self.assertEqual(self.uploader.aborted_count, aborted_count)
+
     def testInstance(self):
         self.assertFalse(self.uploader.is_active())
 
@@ -70,6 +101,24 @@ class TestFilesUploader(unittest.TestCase):
         self.assertIs(uploaded_count + errors_count + aborted_count, len(self.files_list))
         self.assertIs(len(self.files_list) - errors_count - aborted_count, uploaded_count)
 
+    def testStreamingResult(self):
+        output = io.StringIO()
+        self.uploader.write_to(output)
+        result = output.getvalue()
+
+        self.assertEqual(result, self.uploader.result)
+
+        summary = self.uploader.summary
+        self.assertIn(f'Total files: {len(self.files_list)}', summary)
+        self.assertIn(f'Done: {self.uploader.uploaded_count}', summary)
+        self.assertNotIn('Filename:', summary)
+
+        # Сначала перечисляются файлы с ошибками, затем отменённые
+        not_uploaded = result.split('Not uploaded files:\n')[1]
+        lines = [line for line in not_uploaded.split('\n') if line.startswith('Filename:')]
+        statuses = [line.split('status: ')[1].split(':')[0] for line in lines]
+        self.assertEqual(statuses, sorted(statuses, key=('error', 'aborted').index))
+
     def testUpload(self):
         upload = self.uploader._upload
         queue = self.uploader.reports_q
@@ -77,20 +126,20 @@ class TestFilesUploader(unittest.TestCase):
         while not queue.empty():
             queue.get()
 
-        from multiprocessing import Value
-
         total_count = self.uploader.total_count
-        processed_count = Value('i', 0)
-        errors_count = Value('i', 0)
-        start_trigger = Value('i', False)
+        counters = ProgressCounters(1)
 
-        self.uploader._initializer(total_count, processed_count, errors_count, start_trigger)
+        self.uploader._initializer(self.uploader, total_count, counters)
 
         for file in self.uploader.files_to_upload:
             result = upload(file)
-            report = queue.get()
-            self.assertEqual(result.filename, report.filename)
-            self.assertEqual(result.status, report.status)
+            self.assertEqual(result.filename, file)
+            self.assertIn(result.status, ('done', 'error'))
+
+        # Отчёты в очередь отправляет только основной процесс через Uploader._done
+        self.assertTrue(queue.empty())
+        self.assertEqual(counters.totals()[0], total_count)
+        counters.release()
 
     def testReport(self):
         queue = self.uploader.reports_q
@@ -133,6 +182,7 @@ class TestFilesUploaderForceStop(TestFilesUploader):
         q = manager.Queue()
 
         uploader = Uploader(files_list, 4, q)
+        uploader.backend = self.backend
         uploader.error_emulation = True
         uploader.worker_time = 0.1
 
@@ -167,3 +217,1136 @@ class TestFilesUploaderForceStop(TestFilesUploader):
 
         self.assertIs(uploaded_count + errors_count + aborted_count, len(self.files_list))
         self.assertIs(len(self.files_list) - errors_count - aborted_count, uploaded_count)
+
+    def testReport(self):
+        queue = self.uploader.reports_q
+        reports = []
+        while not queue.empty():
+            reports.append(queue.get())
+
+        self.assertTrue(all(isinstance(report, Report) for report in reports))
+
+        # Отчёты о каждом обработанном файле и один общий отчёт об отменённых файлах
+        self.assertEqual(len(reports), self.uploader.processed_count + 1)
+
+        for report in reports[:-1]:
+            self.assertIn(report.filename, self.uploader.files_to_upload)
+            self.assertIn(report.status, ('done', 'error'))
+            self.assertTrue(report.processed_count)
+
+        aborted = reports[-1]
+        self.assertEqual(aborted.status, 'aborted')
+        self.assertIsNone(aborted.filename)
+        self.assertEqual(aborted.aborted_count, self.uploader.aborted_count)
+        self.assertIn(f'of {self.uploader.total_count} files', aborted.progress)
+
+
+class TestFilesUploaderThread(TestFilesUploader):
+    """ Test using normal stop with thread backend """
+
+    backend = 'thread'
+
+
+    def testConcurrentUploaders(self):
+        # Загрузки в одном процессе не делят общие счётчики: окончание второй не освобождает счётчики первой
+        first = Uploader(['file' + str(c) for c in range(200)], 4, queue.Queue())
+        second = Uploader(['file' + str(c) for c in range(20)], 4, queue.Queue())
+        for uploader in (first, second):
+            uploader.backend = self.backend
+            uploader.worker_time = 0.005
+
+        first.start()
+        time.sleep(0.05)
+        second.start()
+        second.join()
+        first.join()
+
+        self.assertEqual((first.uploaded_count, first.errors_count), (200, 0))
+        self.assertEqual((second.uploaded_count, second.errors_count), (20, 0))
+        self.assertEqual(first.reports_q.qsize(), 200)
+
+
+class TestFilesUploaderThreadForceStop(TestFilesUploaderForceStop):
+    """ Test using force stop with thread backend """
+
+    backend = 'thread'
+
+
+class TestFilesUploaderAsyncio(TestFilesUploader):
+    """ Test using normal stop with asyncio backend """
+
+    backend = 'asyncio'
+
+    def testHighConcurrency(self):
+        files_list = ['file' + str(c) for c in range(10000)]
+
+        uploader = Uploader(files_list, 10000, Manager().Queue())
+        uploader.backend = self.backend
+        uploader.worker_time = 0.5
+
+        uploader.start()
+        uploader.join()
+
+        self.assertEqual(uploader.uploaded_count, len(files_list))
+        self.assertLess(uploader._finished_at - uploader._started_at, 30)
+
+    def testTerminateAfterFinish(self):
+        uploader = Uploader(self.files_list, 4, Manager().Queue())
+        uploader.backend = self.backend
+        uploader.worker_time = 0.01
+
+        uploader.start()
+        uploader.join()
+        uploader._pool.terminate()  # Цикл событий уже закрыт
+
+
+class TestFilesUploaderAsyncioForceStop(TestFilesUploaderForceStop):
+    """ Test using force stop with asyncio backend """
+
+    backend = 'asyncio'
+
+
+class TestReportStorage(unittest.TestCase):
+    """ Test compact reports and columnar result store """
+
+    def testSlottedReport(self):
+        report = Report()
+        report.filename = 'file0'
+        report.status = 'error'
+        report.error_message = 'Emulated error'
+
+        self.assertFalse(hasattr(report, '__dict__'))
+        self.assertEqual(report.status_code, Report.STATUS_CODES['error'])
+        self.assertIs(report.status, Report.STATUSES[report.status_code])
+
+        restored = pickle.loads(pickle.dumps(report))
+        self.assertEqual((restored.filename, restored.status, restored.error_message),
+                         ('file0', 'error', 'Emulated error'))
+
+        with self.assertRaises(ValueError):
+            report.status = 'unknown'
+
+    def testResultStore(self):
+        files_list = ['file' + str(c) for c in range(5)]
+        store = ResultStore(files_list)
+        for number, status in enumerate(['done', 'error', 'done', 'aborted', 'done']):
+            report = Report()
+            report.filename = files_list[number]
+            report.status = status
+            if status == 'error':
+                report.error_message = 'Emulated error'
+            store.dispatch(number)
+            store.finish(number, report)
+
+        self.assertEqual(len(store), 5)
+        self.assertEqual(store.count('done'), 3)
+        self.assertEqual(store.filenames('done'), ['file0', 'file2', 'file4'])
+        self.assertEqual(store.filenames('error'), ['file1'])
+        self.assertEqual(store.filenames('aborted'), ['file3'])
+        self.assertEqual([report.error_message for report in store], [None, 'Emulated error', None, None, None])
+
+    def testAbortRemaining(self):
+        files_list = ['file0', 'file1', 'file1', 'file2', 'file1']
+        store = ResultStore(files_list)
+
+        report = Report()
+        report.filename = 'file1'
+        report.status = 'done'
+        store.dispatch(1)
+        store.finish(1, report)
+        store.dispatch(2)  # Выполняется во время остановки
+
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.count('uploading'), 1)
+        self.assertEqual(store.abort_remaining(), 4)
+        self.assertEqual(len(store), 5)
+
+        # Одинаковые имена файлов учитываются по отдельности
+        self.assertEqual(store.filenames('done'), ['file1'])
+        self.assertEqual(store.filenames('aborted'), ['file0', 'file1', 'file2', 'file1'])
+
+
+class TestProgressCounters(unittest.TestCase):
+    """ Test lock-free progress counters """
+
+    def testReleaseTwice(self):
+        counters = ProgressCounters(2)
+        counters.release()
+        counters.release()
+
+    def testWorkerSlots(self):
+        counters = ProgressCounters(5)
+
+        with Pool(4, initializer=_init_counters, initargs=(counters,)) as pool:
+            pool.map(_add_to_counters, range(1000))
+
+        counters.add(processed=1, errors=1)
+        self.assertEqual(counters.totals(), (1001, 501))
+        counters.release()
+
+    def testThreadSlots(self):
+        counters = ProgressCounters(4)
+
+        def work():
+            for number in range(1000):
+                counters.add(processed=1, errors=number % 2)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(counters.totals(), (4000, 2000))
+        counters.release()
+
+
+def _init_counters(counters):
+    global COUNTERS
+    COUNTERS = counters
+
+
+def _add_to_counters(number):
+    COUNTERS.add(processed=1, errors=number % 2)
+
+
+class TestRateLimiter(unittest.TestCase):
+    """ Test the shared token-bucket limiter """
+
+    def testReserve(self):
+        limiter = RateLimiter(100, burst=10)
+
+        self.assertEqual(limiter.reserve(10), 0.0)  # Корзина изначально полная
+        self.assertAlmostEqual(limiter.reserve(50), 0.5, delta=0.05)  # Долг покрывается со скоростью rate
+        self.assertRaises(ValueError, RateLimiter, 0)
+
+    def testSharedBetweenProcesses(self):
+        limiter = RateLimiter(200, burst=1)
+
+        started_at = time.monotonic()
+        with Pool(4, initializer=_init_limiter, initargs=(limiter,)) as pool:
+            pool.map(_acquire_limiter, range(100))
+        elapsed = time.monotonic() - started_at
+
+        self.assertGreater(elapsed, 0.45)  # 100 загрузок при 200 в секунду на всех воркеров
+
+    def testUploaderLimits(self):
+        files_list = ['file' + str(c) for c in range(40)]
+
+        uploader = Uploader(files_list, 8, queue.Queue())
+        uploader.backend = 'thread'
+        uploader.worker_time = 0
+        uploader.uploads_per_second = 100
+
+        started_at = time.monotonic()
+        uploader.start()
+        uploader.join()
+        elapsed = time.monotonic() - started_at
+
+        self.assertEqual(uploader.uploaded_count, len(files_list))
+        self.assertGreater(elapsed, 0.25)  # Первые 10 загрузок проходят без ожидания (rate_burst)
+        self.assertLess(elapsed, 1.0)
+
+
+def _init_limiter(limiter):
+    global LIMITER
+    LIMITER = limiter
+
+
+def _acquire_limiter(number):
+    LIMITER.acquire()
+
+
+class TestProgressChannel(unittest.TestCase):
+    """ Test batched and coalesced progress reporting """
+
+    @staticmethod
+    def _make_report(number):
+        report = Report()
+        report.filename = 'file' + str(number)
+        return report
+
+    def testEach(self):
+        q = queue.Queue()
+        channel = ProgressChannel(q)
+
+        for number in range(5):
+            channel.put(self._make_report(number))
+        channel.close()  # Дожидается отправки всех отчётов
+
+        self.assertEqual(q.qsize(), 5)
+        self.assertIsInstance(q.get(), Report)
+
+    def testSlowReceiver(self):
+        receiver, sender = Pipe(duplex=False)
+        channel = ProgressChannel(sender)
+
+        started = time.monotonic()
+        for number in range(3000):
+            channel.put(self._make_report(number))  # Буфер канала переполнен, но отправитель не ждёт получателя
+        self.assertLess(time.monotonic() - started, 1)
+
+        received = [receiver.recv().filename for _ in range(3000)]
+        channel.close()
+        self.assertEqual(received, ['file' + str(number) for number in range(3000)])
+
+    def testBatch(self):
+        q = queue.Queue()
+        channel = ProgressChannel(q, 'batch', batch_size=4, interval=60)
+
+        for number in range(10):
+            channel.put(self._make_report(number))
+
+        self.assertEqual([len(q.get(timeout=1)) for _ in range(2)], [4, 4])
+        channel.close()
+        self.assertEqual(q.qsize(), 1)
+        self.assertEqual([report.filename for report in q.get()], ['file8', 'file9'])
+
+    def testBatchInterval(self):
+        q = queue.Queue()
+        channel = ProgressChannel(q, 'batch', batch_size=100, interval=0.05)
+
+        channel.put(self._make_report(0))
+        batch = q.get(timeout=1)  # Отправляется фоновым потоком без новых отчётов
+        self.assertEqual(len(batch), 1)
+        channel.close()
+
+    def testLatestPipe(self):
+        receiver, sender = Pipe(duplex=False)
+        channel = ProgressChannel(sender, 'latest', interval=60)
+
+        for number in range(10):
+            channel.put(self._make_report(number))
+        channel.close()
+
+        self.assertEqual(receiver.recv().filename, 'file9')
+        self.assertFalse(receiver.poll())
+
+    def testUploaderWithoutManager(self):
+        files_list = ['file' + str(c) for c in range(100)]
+        q = multiprocessing.Queue()
+
+        uploader = Uploader(files_list, 4, q)
+        uploader.worker_time = 0
+        uploader.progress_mode = 'batch'
+        uploader.progress_batch_size = 16
+
+        uploader.start()
+        uploader.join()
+        self.assertFalse(uploader.is_active())
+
+        received = []
+        while len(received) < len(files_list):
+            received.extend(q.get(timeout=1))
+        self.assertEqual(sorted(report.filename for report in received), sorted(files_list))
+
+
+class TestFilesUploaderDispatch(unittest.TestCase):
+    """ Test dispatching files to the process pool """
+
+    def testWorkerStateIsLean(self):
+        uploader = Uploader(['file' + str(c) for c in range(100000)], 4, None)
+        uploader._result = list(range(100000))
+        uploader.file_sizes = list(range(100000))  # Воркерам нужна только часть файла в самой задаче
+
+        state = pickle.loads(pickle.dumps(uploader))
+        self.assertIsNone(state.files_to_upload)
+        self.assertIsNone(state._result)
+        self.assertEqual(state.worker_time, uploader.worker_time)
+        self.assertLess(len(pickle.dumps(uploader)), 1024)
+
+    def testBatchedDispatch(self):
+        files_list = ['file' + str(c) for c in range(200)]
+
+        uploader = Uploader(files_list, 4, Manager().Queue())
+        uploader.worker_time = 0
+        uploader.chunksize = 16
+
+        uploader.start()
+        uploader.join()
+
+        self.assertEqual(uploader.uploaded_count, len(files_list))
+        self.assertEqual(sorted(uploader.uploaded_files), sorted(files_list))
+
+    def testDuplicateFiles(self):
+        files_list = ['file0', 'file0', 'file1', 'file0']
+
+        uploader = Uploader(files_list, 2, Manager().Queue())
+        uploader.worker_time = 0
+
+        uploader.start()
+        uploader.join()
+
+        self.assertEqual(len(uploader._result), len(files_list))
+        self.assertEqual(uploader.uploaded_files, files_list)
+
+
+class TestFilesUploaderRetries(unittest.TestCase):
+    """ Test retrying failed uploads with backoff """
+
+    def testDispatcherBackoff(self):
+        files_list = ['file0', 'file1', 'file2']
+        store = ResultStore(files_list)
+        dispatcher = Dispatcher(files_list, store, max_attempts=2, backoff=0.2, jitter=0)
+
+        index, file, _, attempt, part = next(iter(dispatcher))
+        report = Report()
+        report.filename, report.status, report.attempt = file, 'error', attempt
+        self.assertIsNone(dispatcher.done(index, report))
+        self.assertEqual(store.count('pending'), 3)
+
+        # Повторная попытка ещё не готова, но новые файлы раздаются без ожидания
+        self.assertEqual(dispatcher.poll(), ((1, 'file1', UPLOAD, 1, None), None))
+        self.assertEqual(dispatcher.poll(), ((2, 'file2', UPLOAD, 1, None), None))
+        task, wait = dispatcher.poll()
+        self.assertIsNone(task)
+        self.assertGreater(wait, 0.1)
+
+        tasks = next(dispatcher.batches(size=4))
+        self.assertEqual(tasks, [(0, 'file0', UPLOAD, 2, None)])
+
+        # Последняя попытка на повтор не ставится
+        report.attempt = 2
+        self.assertIs(dispatcher.done(0, report), report)
+
+    def testRetries(self):
+        files_list = ['file' + str(c) for c in range(60)]
+        reports_q = queue.Queue()
+
+        uploader = Uploader(files_list, 8, reports_q)
+        uploader.backend = 'thread'
+        uploader.worker_time = 0
+        uploader.error_emulation = True
+        uploader.retry_attempts = 5
+        uploader.retry_backoff = 0.01
+
+        uploader.start()
+        uploader.join()
+
+        self.assertGreater(uploader.retries_count, 0)
+        self.assertEqual(uploader.uploaded_count + uploader.errors_count, len(files_list))
+        self.assertEqual(reports_q.qsize(), len(files_list))
+
+        # В очередь попадают только итоговые отчёты, ошибки - после всех попыток
+        reports = [reports_q.get() for _ in files_list]
+        self.assertTrue(all(report.attempt == 5 for report in reports if report.status == 'error'))
+        self.assertTrue(any(report.attempt > 1 for report in reports))
+
+
+class TestFilesUploaderScheduling(unittest.TestCase):
+    """ Test size-aware dispatching """
+
+    def testLargestFirst(self):
+        files_list = ['small', 'large', 'medium', 'large2']
+        dispatcher = Dispatcher(files_list, ResultStore(files_list), sizes=[1, 100, 10, 100], largest_first=True)
+
+        order = [file for _, file, _, _, _ in next(dispatcher.batches(size=4))]
+        self.assertEqual(order, ['large', 'large2', 'medium', 'small'])
+
+    def testSplitParts(self):
+        files_list = ['small', 'large']
+        dispatcher = Dispatcher(files_list, ResultStore(files_list), sizes=[10, 250], part_size=100)
+
+        tasks = next(dispatcher.batches(size=10))
+        self.assertEqual([part for _, _, _, _, part in tasks],
+                         [(0, 10, 10), (0, 100, 250), (100, 100, 250), (200, 50, 250)])
+
+        # Итоговый отчёт о файле появляется только после загрузки всех его частей
+        finals = []
+        for index, file, _, _, part in tasks:
+            report = Report()
+            report.filename, report.status, report.part, report.bytes_sent = file, 'done', part, part[1]
+            finals.append(dispatcher.done(index, report))
+
+        self.assertEqual(finals[:3], [finals[0], None, None])
+        self.assertEqual(finals[3].filename, 'large')
+        self.assertEqual(finals[3].bytes_sent, 250)
+
+    def testSizeSettingsValidation(self):
+        invalid = [{'schedule': 'largest_first'}, {'part_size': 100}, {'file_sizes': [1, 2]},
+                   {'emulated_speed': 100}, {'bytes_per_second': 100},
+                   {'file_sizes': [1, 2, 3], 'files_to_upload': iter(['file0', 'file1', 'file2'])}]
+        for settings in invalid:
+            with self.subTest(settings=settings):
+                uploader = Uploader(['file0', 'file1', 'file2'], 2, queue.Queue())
+                for name, value in settings.items():
+                    setattr(uploader, name, value)
+                self.assertRaises(ValueError, uploader.start)
+                self.assertFalse(uploader.is_active())
+
+    def testStatSizes(self):
+        with tempfile.NamedTemporaryFile() as file:
+            file.write(b'x' * 10)
+            file.flush()
+            self.assertEqual(stat_sizes([file.name, file.name + '.missing']), [10, 0])
+
+    def testSkewedMakespan(self):
+        # Один крупный файл в конце списка растягивает загрузку по порядку списка
+        files_list = ['file' + str(c) for c in range(12)]
+        sizes = [1] * 11 + [8]
+
+        elapsed = {}
+        for schedule, part_size in (('fifo', None), ('largest_first', 2)):
+            uploader = Uploader(files_list, 4, queue.Queue())
+            uploader.backend = 'thread'
+            uploader.emulated_speed = 20
+            uploader.file_sizes = sizes
+            uploader.schedule = schedule
+            uploader.part_size = part_size
+
+            started_at = time.monotonic()
+            uploader.start()
+            uploader.join()
+            elapsed[schedule] = time.monotonic() - started_at
+
+            self.assertEqual(uploader.uploaded_count, len(files_list))
+            self.assertEqual(uploader.processed_count, len(files_list))
+
+        self.assertLess(elapsed['largest_first'], elapsed['fifo'])
+
+
+class TestFilesUploaderErrorRate(unittest.TestCase):
+    """ Test configurable error emulation rate """
+
+    def testErrorRate(self):
+        files_list = ['file' + str(c) for c in range(50)]
+
+        for error_rate, expected in ((0.0, 0), (1.0, len(files_list))):
+            uploader = Uploader(files_list, 4, queue.Queue())
+            uploader.backend = 'thread'
+            uploader.worker_time = 0
+            uploader.error_emulation = True
+            uploader.error_rate = error_rate
+
+            uploader.start()
+            uploader.join()
+
+            self.assertEqual(uploader.errors_count, expected)
+
+
+class TestFilesUploaderConcurrency(unittest.TestCase):
+    """ Test adaptive concurrency """
+
+    @staticmethod
+    def _make_report(latency, status='done'):
+        report = Report()
+        report.status = status
+        report.started_at, report.finished_at = 0.0, latency
+        return report
+
+    def testController(self):
+        controller = ConcurrencyController(4, minimum=2, maximum=6)
+
+        # Окно - текущий предел: пока задержки не растут, предел увеличивается на единицу до maximum
+        for limit in (4, 5, 6, 6):
+            for _ in range(limit):
+                controller.observe(self._make_report(0.1))
+        self.assertEqual(controller.limit, 6)
+
+        # Рост задержки и ошибки уменьшают предел в два раза, но не ниже minimum
+        for _ in range(6):
+            controller.observe(self._make_report(0.5))
+        self.assertEqual(controller.limit, 3)
+        for _ in range(3):
+            controller.observe(self._make_report(0.1, 'error'))
+        self.assertEqual(controller.limit, 2)
+
+        self.assertEqual([limit for _, limit in controller.trace], [4, 5, 6, 3, 2])
+        self.assertRaises(ValueError, ConcurrencyController, 4, 5, 3)
+
+    def testDispatcherLimit(self):
+        files_list = ['file' + str(c) for c in range(5)]
+        controller = ConcurrencyController(2, maximum=4)
+        dispatcher = Dispatcher(files_list, ResultStore(files_list), controller=controller)
+
+        tasks = next(dispatcher.batches(size=5))
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(dispatcher.poll(), (None, None))
+
+        for index, file, _, _, _ in tasks:
+            report = self._make_report(0.1)
+            report.filename = file
+            dispatcher.done(index, report)
+        self.assertEqual(len(next(dispatcher.batches(size=5))), 3)
+
+    def testAdaptiveUploader(self):
+        files_list = ['file' + str(c) for c in range(200)]
+
+        traces = {}
+        for error_emulation in (False, True):
+            uploader = Uploader(files_list, 4, queue.Queue())
+            uploader.backend = 'thread'
+            uploader.worker_time = 0.005
+            uploader.error_emulation = error_emulation
+            uploader.adaptive_concurrency = True
+            uploader.concurrency_max = 8
+
+            uploader.start()
+            uploader.join()
+
+            traces[error_emulation] = [limit for _, limit in uploader.concurrency_trace]
+            self.assertEqual(uploader.processed_count, len(files_list))
+            self.assertEqual(uploader.concurrency_trace[0], (0.0, 4))
+            self.assertTrue(all(1 <= limit <= 8 for limit in traces[error_emulation]))
+
+        # Без ошибок число загрузок растёт до concurrency_max, а частые ошибки сбрасывают его до минимума
+        self.assertEqual(traces[False][-1], 8)
+        self.assertEqual(min(traces[True]), 1)
+
+    def testMaximumBelowThreads(self):
+        uploader = Uploader(['file' + str(c) for c in range(20)], 8, queue.Queue())
+        uploader.backend = 'thread'
+        uploader.worker_time = 0.005
+        uploader.adaptive_concurrency = True
+        uploader.concurrency_max = 2
+
+        uploader.start()
+        uploader.join()
+
+        self.assertEqual(uploader.workers_count, 2)
+        self.assertEqual(uploader.concurrency_trace[0], (0.0, 2))
+        self.assertTrue(all(limit <= 2 for _, limit in uploader.concurrency_trace))
+
+
+class TestFilesUploaderMetrics(unittest.TestCase):
+    """ Test per-file timing and metrics export """
+
+    def testHistogram(self):
+        histogram = Histogram((0.1, 1.0, float('inf')))
+        for value in (0.05, 0.05, 0.5, 5.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(0.99), float('inf'))
+        self.assertEqual(histogram.snapshot()['buckets'], [(0.1, 2), (1.0, 3), (float('inf'), 4)])
+
+    def testProcessMetrics(self):
+        files_list = ['file' + str(c) for c in range(40)]
+        reports_q = queue.Queue()
+        published = []
+
+        uploader = Uploader(files_list, 4, reports_q)
+        uploader.worker_time = 0.01
+        uploader.metrics_hook = published.append
+
+        uploader.start()
+        uploader.join()
+
+        # Время выдачи задачи, начала и окончания загрузки идут по одним часам во всех процессах
+        reports = [reports_q.get() for _ in files_list]
+        self.assertTrue(all(report.enqueued_at <= report.started_at < report.finished_at for report in reports))
+        self.assertTrue(all(report.worker_pid != os.getpid() for report in reports))
+
+        metrics = published[-1]
+        self.assertEqual(metrics['attempts']['done'], len(files_list))
+        self.assertEqual(metrics['in_flight'], 0)
+        self.assertEqual(metrics['latency']['upload']['count'], len(files_list))
+        self.assertGreaterEqual(metrics['latency']['upload']['p50'], 0.01)
+        self.assertEqual(sum(worker['uploads'] for worker in metrics['workers'].values()), len(files_list))
+        self.assertEqual(len({worker['pid'] for worker in metrics['workers'].values()}), len(metrics['workers']))
+
+        text = uploader.export_metrics()
+        self.assertIn(f'uploader_attempts_total{{status="done"}} {len(files_list)}', text)
+        self.assertIn(f'uploader_upload_seconds_bucket{{le="+Inf"}} {len(files_list)}', text)
+        self.assertEqual(json.loads(uploader.export_metrics('json'))['attempts']['done'], len(files_list))
+        self.assertRaises(ValueError, uploader.export_metrics, 'xml')
+
+    def testThreadWorkers(self):
+        uploader = Uploader(['file' + str(c) for c in range(40)], 4, queue.Queue())
+        uploader.backend = 'thread'
+        uploader.worker_time = 0.01
+
+        uploader.start()
+        uploader.join()
+
+        # Потоки одного процесса учитываются как отдельные воркеры
+        workers = uploader.metrics()['workers']
+        self.assertGreater(len(workers), 1)
+        self.assertEqual({worker['pid'] for worker in workers.values()}, {os.getpid()})
+        self.assertIn(f'thread="{next(iter(workers.values()))["thread"]}"', uploader.export_metrics())
+
+    def testFailingHook(self):
+        def hook(metrics):
+            raise RuntimeError('hook failed')
+
+        for backend in Uploader.BACKENDS:
+            with self.subTest(backend=backend):
+                uploader = Uploader(['file' + str(c) for c in range(20)], 4, queue.Queue())
+                uploader.backend = backend
+                uploader.worker_time = 0.01
+                uploader.metrics_hook = hook
+                uploader.metrics_interval = 0
+
+                uploader.start()
+                uploader.join()
+
+                # Исключение в metrics_hook не мешает загрузке
+                self.assertFalse(uploader.is_active())
+                self.assertEqual(uploader.uploaded_count, 20)
+                self.assertIsInstance(uploader.metrics_hook_error, RuntimeError)
+
+    def testFailingCallback(self):
+        for backend in Uploader.BACKENDS:
+            with self.subTest(backend=backend):
+                uploader = Uploader(['file' + str(c) for c in range(20)], 4, queue.Queue())
+                uploader.backend = backend
+                uploader.worker_time = 0.01
+
+                # Ошибка обработки результатов останавливает загрузку и выбрасывается из join()
+                with mock.patch.object(Uploader, '_complete', side_effect=RuntimeError('callback failed')):
+                    uploader.start()
+                    self.assertRaises(RuntimeError, uploader.join)
+
+                self.assertFalse(uploader.is_active())
+                self.assertTrue(uploader.terminated)
+                self.assertEqual(uploader.aborted_count, 20)
+
+
+class TestFilesUploaderJournal(unittest.TestCase):
+    """ Test resuming uploads from the checkpoint journal """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'journal.db')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def testJournal(self):
+        journal = Journal(self.path, batch_size=3, interval=60)
+        journal.record('file0')
+        journal.record('file1', 0)
+        self.assertTrue(journal.is_done('file0'))
+        self.assertTrue(journal.part_done('file1', 0))
+
+        # Записи фиксируются пачками: без close() сохраняется только полная пачка
+        journal.record('file1', 100)
+        journal.record('file2')
+        self.assertEqual(len(Journal(self.path)), 1)
+        journal.close()
+
+        journal = Journal(self.path)
+        self.assertEqual(len(journal), 2)
+        self.assertTrue(journal.is_done('file2'))
+        self.assertTrue(journal.part_done('file1', 100))
+        self.assertFalse(journal.is_done('file1'))
+
+        # Части удаляются, когда загружен весь файл
+        journal.record('file1')
+        journal.close()
+        self.assertFalse(Journal(self.path).part_done('file1', 0))
+
+    def testDispatcherSkipsParts(self):
+        journal = Journal(self.path)
+        journal.record('large', 0)
+        journal.record('large', 200)
+        journal.close()
+
+        files_list = ['small', 'large']
+        dispatcher = Dispatcher(files_list, ResultStore(files_list), sizes=[10, 250], part_size=100,
+                                journal=Journal(self.path))
+        tasks = next(dispatcher.batches(size=10))
+        self.assertEqual([part for _, _, _, _, part in tasks], [(0, 10, 10), (100, 100, 250)])
+
+        report = Report()
+        report.filename, report.status, report.part, report.bytes_sent = 'large', 'done', (100, 100, 250), 100
+        self.assertIs(dispatcher.done(1, report), report)
+
+    def testResume(self):
+        files_list = ['file' + str(c) for c in range(40)]
+
+        uploader = Uploader(files_list, 4, queue.Queue())
+        uploader.backend = 'thread'
+        uploader.worker_time = 0.01
+        uploader.journal = self.path
+
+        uploader.start()
+        while uploader.processed_count < 10:
+            time.sleep(0.001)
+        uploader.stop()
+        uploaded_files = uploader.uploaded_files
+
+        reports_q = queue.Queue()
+        uploader = Uploader(files_list, 4, reports_q)
+        uploader.worker_time = 0.01
+        uploader.journal = self.path
+
+        uploader.start()
+        uploader.join()
+
+        self.assertEqual(uploader.resumed_count, len(uploaded_files))
+        self.assertEqual(uploader.uploaded_count, len(files_list))
+        self.assertEqual(uploader.processed_count, len(files_list))
+        self.assertEqual(reports_q.qsize(), len(files_list) - len(uploaded_files))
+        self.assertNotIn(reports_q.get().filename, uploaded_files)
+
+        # Повторный запуск с полным журналом сразу завершается
+        uploader = Uploader(files_list, 4, queue.Queue())
+        uploader.journal = self.path
+        uploader.start()
+        uploader.join()
+
+        self.assertFalse(uploader.is_active())
+        self.assertEqual(uploader.resumed_count, len(files_list))
+
+
+class TestFilesUploaderLazyInput(unittest.TestCase):
+    """ Test uploading from iterators and directory walks """
+
+    def testGeneratorBackpressure(self):
+        files = ('file' + str(c) for c in range(10 ** 7))
+
+        for backend in Uploader.BACKENDS:
+            reports_q = queue.Queue()
+            uploader = Uploader(files, 4, reports_q)
+            uploader.backend = backend
+            uploader.worker_time = 0.01
+            self.assertIsNone(uploader.total_count)
+
+            started_at = time.monotonic()
+            uploader.start()
+            report = reports_q.get(timeout=5)
+            self.assertLess(time.monotonic() - started_at, 2)
+            self.assertIn('of ? files', report.progress)
+            uploader.stop()
+
+            # Из генератора прочитано не больше, чем воркеры успели загрузить, и задачи в очереди пулов
+            read = uploader._result.added
+            self.assertLessEqual(read, uploader.processed_count + 4 * (uploader.prefetch + 1) + 1)
+            self.assertEqual(uploader.processed_count + uploader.aborted_count, read)
+            self.assertIn('Total files: ?', uploader.summary)
+
+    def testInputError(self):
+        def broken_input(count):
+            yield from ('file' + str(c) for c in range(count))
+            raise OSError('Broken input')
+
+        for backend in Uploader.BACKENDS:
+            for count in (0, 5):
+                with self.subTest(backend=backend, count=count):
+                    uploader = Uploader(broken_input(count), 2, queue.Queue())
+                    uploader.backend = backend
+                    uploader.worker_time = 0.01
+
+                    uploader.start()
+                    with self.assertRaises(OSError):
+                        uploader.join()
+
+                    # Прочитанные файлы загружаются до конца, а ошибка попадает в итоговый отчёт
+                    self.assertFalse(uploader.is_active())
+                    self.assertEqual(uploader.processed_count, count)
+                    self.assertEqual(uploader.total_count, count)
+                    self.assertIsInstance(uploader.input_error, OSError)
+                    self.assertIn('INPUT ERROR', uploader.result)
+
+    def testReadWithoutLock(self):
+        resume = threading.Event()
+
+        def slow_input():
+            yield 'file0'
+            resume.wait(5)  # Долгое чтение, например пропуск неизменившихся файлов по кешу
+            yield 'file1'
+
+        store = ResultStore(iter(()))
+        dispatcher = Dispatcher(slow_input(), store)
+        self.assertEqual(store.added, 0)  # Создание очереди ничего не читает
+
+        index, file, _, attempt, part = dispatcher.poll()[0]
+        reader = threading.Thread(target=dispatcher.poll)
+        reader.start()
+        time.sleep(0.05)
+
+        # Пока другой поток читает входные данные, отчёты принимаются без ожидания
+        report = Report()
+        report.filename, report.status, report.attempt = file, 'done', attempt
+        started_at = time.monotonic()
+        self.assertIs(dispatcher.done(index, report), report)
+        self.assertLess(time.monotonic() - started_at, 1)
+
+        resume.set()
+        reader.join()
+        self.assertEqual(store.added, 2)
+
+    def testWalkFiles(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            expected = []
+            for directory in ('', 'a', os.path.join('a', 'b'), 'c'):
+                os.makedirs(os.path.join(tmp_dir, directory), exist_ok=True)
+                for number in range(3):
+                    path = os.path.join(tmp_dir, directory, f'file{number}')
+                    with open(path, 'wb') as file:
+                        file.write(b'x' * 1000 * number)
+                    expected.append(path)
+
+            self.assertEqual(sorted(walk_files(tmp_dir)), sorted(expected))
+
+            uploader = Uploader(walk_files(tmp_dir), 2, queue.Queue())
+            uploader.sink = NullSink()
+            uploader.file_sizes = 'stat'
+            uploader.part_size = 512
+
+            uploader.start()
+            uploader.join()
+
+            self.assertEqual(uploader.total_count, len(expected))
+            self.assertEqual(sorted(uploader.uploaded_files), sorted(expected))
+            self.assertEqual(uploader.bytes_uploaded, 4 * 3000)
+
+    def testDropUploadedNames(self):
+        uploader = Uploader(iter(['file' + str(c) for c in range(30)]), 4, queue.Queue())
+        uploader.backend = 'thread'
+        uploader.worker_time = 0
+        uploader.error_emulation = True
+        uploader.keep_uploaded_files = False
+
+        uploader.start()
+        uploader.join()
+
+        self.assertEqual(uploader.uploaded_files, [])
+        self.assertEqual(len(uploader.error_files), uploader.errors_count)
+        self.assertIn(f'Done: {uploader.uploaded_count}', uploader.result)
+
+    def testResumeGenerator(self):
+        files_list = ['file' + str(c) for c in range(20)]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            journal = Journal(os.path.join(tmp_dir, 'journal.db'))
+            for file in files_list[:5] + files_list[-5:]:
+                journal.record(file)
+            journal.close()
+
+            reports_q = queue.Queue()
+            uploader = Uploader(iter(files_list), 4, reports_q)
+            uploader.backend = 'thread'
+            uploader.worker_time = 0
+            uploader.journal = journal.path
+
+            uploader.start()
+            uploader.join()
+
+        self.assertFalse(uploader.is_active())
+        self.assertEqual(uploader.resumed_count, 10)
+        self.assertEqual(uploader.uploaded_count, len(files_list))
+        self.assertEqual(reports_q.qsize(), 10)
+
+
+class TestFilesUploaderCache(unittest.TestCase):
+    """ Test skipping unchanged and duplicate files by the content-hash cache """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'cache.db')
+        self.files_list = []
+        for number in range(12):
+            self.files_list.append(os.path.join(self.tmp_dir.name, f'file{number}'))
+            with open(self.files_list[-1], 'wb') as file:
+                file.write(b'duplicate' if number % 3 == 0 else os.urandom(100))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def upload(self, backend='thread', **settings):
+        reports_q = queue.Queue()
+        uploader = Uploader(self.files_list, 4, reports_q)
+        uploader.backend = backend
+        uploader.sink = NullSink()
+        uploader.cache = self.path
+        for name, value in settings.items():
+            setattr(uploader, name, value)
+        uploader.start()
+        uploader.join()
+        return uploader, [reports_q.get() for _ in range(reports_q.qsize())]
+
+    def testCache(self):
+        cache = UploadCache(self.path, max_entries=2)
+        cache.add('file0', b'0', 1, 1)
+        cache.add('file1', b'1', 1, 1)
+        self.assertTrue(cache.matches('file0', b'0', 1, 2))  # file1 становится самой давней записью
+        cache.add('file2', b'2', 1, 1)
+        self.assertEqual(len(cache), 2)
+        cache.close()
+
+        cache = UploadCache(self.path, max_entries=2)
+        self.assertFalse(cache.matches('file1', b'1', 1, 1))
+        self.assertTrue(cache.matches('file2', b'2', 1, 1))
+        self.assertTrue(cache.matches('file0', b'0', 1, 2))
+        cache.close()
+
+        # При меньшем размере вытесняются самые давние записи
+        cache = UploadCache(self.path, max_entries=1)
+        self.assertFalse(cache.matches('file2', b'2', 1, 1))
+        self.assertTrue(cache.matches('file0', b'0', 1, 2))
+
+    def testSkipDuplicates(self):
+        for backend in Uploader.BACKENDS:
+            with self.subTest(backend=backend):
+                uploader, reports = self.upload(backend, cache=':memory:')
+                skipped = [report.filename for report in reports if report.status == 'skipped']
+                self.assertEqual(uploader.skipped_count, 3)
+                self.assertEqual(uploader.uploaded_count, 9)
+                self.assertEqual(uploader.processed_count, len(self.files_list))
+                self.assertEqual(sorted(skipped), sorted(uploader.skipped_files))
+                self.assertEqual(uploader.bytes_uploaded, 8 * 100 + len(b'duplicate'))
+                self.assertIn('Skipped files:', uploader.result)
+
+    def testSkipUnchanged(self):
+        self.upload()
+        with open(self.files_list[1], 'ab') as file:
+            file.write(b'changed')
+        os.utime(self.files_list[2])  # Изменилось только время: содержимое сверяется по хешу
+
+        uploader, reports = self.upload('process')
+        self.assertEqual(uploader.uploaded_files, [self.files_list[1]])
+        self.assertEqual(uploader.skipped_count, len(self.files_list) - 1)
+        # Отдельные отчёты отправляются о файлах, для которых вычислялся хеш, об остальных - один общий
+        self.assertEqual(sorted((report.filename or '', report.status) for report in reports),
+                         [('', 'skipped'), (self.files_list[1], 'done'), (self.files_list[2], 'skipped')])
+
+        uploader, reports = self.upload(file_sizes='stat', part_size=40)
+        self.assertEqual(uploader.skipped_count, len(self.files_list))
+        # О файлах, пропущенных без чтения, отправляется один общий отчёт
+        self.assertEqual([(report.filename, report.status, report.skipped_count) for report in reports],
+                         [(None, 'skipped', len(self.files_list))])
+
+    def testHashTasks(self):
+        files_list = self.files_list[:2]
+        cache = UploadCache()
+        dispatcher = Dispatcher(files_list, ResultStore(files_list), dedup=Deduplicator(cache))
+
+        # Сначала выдаются задачи вычисления хеша, а после отчёта о хеше - загрузка того же файла
+        tasks = next(dispatcher.batches(size=2))
+        self.assertEqual(tasks, [(0, files_list[0], HASH, 1, None), (1, files_list[1], HASH, 1, None)])
+        uploader, counters = Uploader(files_list, 1, None), ProgressCounters(1)
+        Uploader._initializer(uploader, len(files_list), counters)
+        for index, file, kind, attempt, part in tasks:
+            report = uploader._execute(kind, file, attempt, part)
+            self.assertEqual((report.kind, report.attempt), (HASH, 1))
+            self.assertIsNone(dispatcher.done(index, report))
+        self.assertEqual(next(dispatcher.batches(size=2)),
+                         [(0, files_list[0], UPLOAD, 1, None), (1, files_list[1], UPLOAD, 1, None)])
+        counters.release()
+        cache.close()
+
+    def testLargestFirstAfterHash(self):
+        files_list = ['a', 'b', 'c', 'd']
+        cache = UploadCache()
+        dispatcher = Dispatcher(files_list, ResultStore(files_list), sizes=[1, 100, 10, 1000], largest_first=True,
+                                dedup=Deduplicator(cache))
+
+        tasks = next(dispatcher.batches(size=4))
+        self.assertEqual([file for _, file, _, _, _ in tasks], ['d', 'b', 'c', 'a'])
+        for index, file, kind, attempt, part in reversed(tasks):  # Мелкие файлы хешируются быстрее
+            report = Report()
+            report.filename, report.status, report.kind, report.part = file, 'done', kind, part
+            report.content = (file.encode(), part[1], 0)
+            dispatcher.done(index, report)
+
+        # Загрузки после вычисления хеша тоже раздаются начиная с самых крупных
+        self.assertEqual([file for _, file, _, _, _ in next(dispatcher.batches(size=4))], ['d', 'b', 'c', 'a'])
+        cache.close()
+
+    def testHashError(self):
+        self.files_list.append(os.path.join(self.tmp_dir.name, 'missing'))
+        uploader, _ = self.upload()
+        self.assertEqual(uploader.error_files, [self.files_list[-1]])
+        self.assertEqual(uploader.processed_count, len(self.files_list))
+
+
+class TestFilesUploaderStreaming(unittest.TestCase):
+    """ Test using real files streamed into a sink """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        sizes = [0, 1, 1000, 64 * 1024, 300 * 1024, 1024 * 1024 + 7]
+
+        files_list = []
+        for number, size in enumerate(sizes):
+            path = os.path.join(self.tmp_dir.name, f'file{number}')
+            with open(path, 'wb') as file:
+                file.write(os.urandom(size))
+            files_list.append(path)
+
+        self.files_list = files_list
+        self.total_size = sum(sizes)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _create_uploader(self, sink):
+        manager = Manager()
+        uploader = Uploader(self.files_list, 3, manager.Queue())
+        uploader.sink = sink
+        uploader.chunk_size = 64 * 1024
+        uploader.mmap_threshold = 256 * 1024
+        return uploader
+
+    def testNullSink(self):
+        uploader = self._create_uploader(NullSink())
+        uploader.start()
+        uploader.join()
+
+        self.assertEqual(uploader.uploaded_count, len(self.files_list))
+        self.assertEqual(uploader.bytes_uploaded, self.total_size)
+        self.assertGreater(uploader.throughput, 0)
+
+    def testSocketSink(self):
+        with LocalSinkServer() as server:
+            uploader = self._create_uploader(SocketSink(server.address))
+            uploader.start()
+            uploader.join()
+
+        self.assertEqual(uploader.bytes_uploaded, self.total_size)
+        self.assertEqual(server.received, self.total_size)
+
+    def testSocketSinkInThreads(self):
+        for backend in ('thread', 'asyncio'):
+            with self.subTest(backend=backend):
+                # Сервер дожидается закрытия всех соединений, поэтому аплоадер должен закрыть приёмник
+                with LocalSinkServer() as server:
+                    uploader = self._create_uploader(SocketSink(server.address))
+                    uploader.backend = backend
+                    uploader.start()
+                    uploader.join()
+
+                self.assertEqual(server.received, self.total_size)
+                self.assertLessEqual(len(server._threads), uploader.threads_count)  # Соединение на поток
+
+    def testSocketSinkPickle(self):
+        sink = pickle.loads(pickle.dumps(SocketSink(('127.0.0.1', 1))))
+        self.assertEqual(sink.address, ('127.0.0.1', 1))
+        sink.close()
+
+    def testBandwidthLimit(self):
+        uploader = self._create_uploader(NullSink())
+        uploader.bytes_per_second = 4 * 1024 * 1024
+        uploader.rate_burst = 0
+
+        uploader.start()
+        uploader.join()
+
+        self.assertEqual(uploader.bytes_uploaded, self.total_size)
+        self.assertLess(uploader.throughput, 4 * 1.1)
+        self.assertGreater(uploader.throughput, 4 * 0.5)
+
+    def testMissingFile(self):
+        uploader = self._create_uploader(NullSink())
+        uploader.files_to_upload = self.files_list + [os.path.join(self.tmp_dir.name, 'missing')]
+        uploader.total_count = len(uploader.files_to_upload)
+        uploader.start()
+        uploader.join()
+
+        self.assertEqual(uploader.errors_count, 1)
+        self.assertEqual(uploader.error_files, [uploader.files_to_upload[-1]])
+
+    def testSplitLargeFiles(self):
+        with LocalSinkServer() as server:
+            uploader = self._create_uploader(SocketSink(server.address))
+            uploader.file_sizes = 'stat'
+            uploader.schedule = 'largest_first'
+            uploader.part_size = 100 * 1024
+            uploader.start()
+            uploader.join()
+
+        self.assertEqual(uploader.uploaded_files, self.files_list)
+        self.assertEqual(uploader.bytes_uploaded, self.total_size)
+        self.assertEqual(server.received, self.total_size)